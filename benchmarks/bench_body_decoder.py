@@ -0,0 +1,119 @@
+"""Benchmark the primary handler's request body decoding.
+
+Bodies are escaped the way API Gateway's $util.escapeJavaScript escapes them
+and then decoded with the legacy ``unicode_escape`` + ``json.loads`` path and
+with ``body_decoder.decode_body``. The script reports throughput for both and
+how many payloads each path returns different from what was sent.
+
+    python3 benchmarks/bench_body_decoder.py --records 20000 --repeat 5
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib", "lambdas", "PrimaryHandlerLambda"))
+
+import body_decoder  # noqa: E402
+
+MESSAGES = [
+    "Your one-time password (OTP) for Nutrition.co is 123456.",
+    "Olá João, a sua encomenda nº 4521 já foi enviada.",
+    "Bonjour Zoë, votre rendez-vous est confirmé à 14h30 — à bientôt !",
+    "Ihre Bestellung über 49,99 € wurde versandt. Grüße aus Köln",
+    "ご注文ありがとうございます。配送状況はこちら: https://example.com/t/1",
+    "Your parcel is on its way 🚚📦 track it at https://example.com/t/2?id=9&ref=\"sms\"",
+    "It's ready! Pick-up code:\n  A1-B2\tC3 \\ path C:\\orders\\77",
+    "Поздравляем! Ваш заказ готов к выдаче 🎉",
+]
+
+SHORT_ESCAPES = {'"': '\\"', "'": "\\'", "\\": "\\\\", "/": "\\/",
+                 "\b": "\\b", "\n": "\\n", "\t": "\\t", "\f": "\\f", "\r": "\\r"}
+
+
+def escape_javascript(text):
+    # Same output as API Gateway's $util.escapeJavaScript (Commons Lang rules)
+    out = []
+    for char in text:
+        if char in SHORT_ESCAPES:
+            out.append(SHORT_ESCAPES[char])
+        elif ord(char) < 32 or ord(char) > 0x7E:
+            encoded = char.encode("utf-16-be")
+            for index in range(0, len(encoded), 2):
+                out.append("\\u%04X" % int.from_bytes(encoded[index:index + 2], "big"))
+        else:
+            out.append(char)
+    return "".join(out)
+
+
+def make_payload(rng):
+    primary, fallback = rng.sample(["email", "sms", "whatsapp"], 2)
+
+    def channel(name):
+        message = rng.choice(MESSAGES)
+        content = {
+            "email": {"subject": message[:30], "text": message, "html": f"<p>{message}</p>",
+                      "configuration_set": "ses-config-set"},
+            "sms": {"message": message, "message_type": "TRANSACTIONAL", "configuration_set": "sms-config-set"},
+            "whatsapp": {"message": message},
+        }[name]
+        recipient = "customer@example.com" if name == "email" else "+447700900123"
+        return {"channel": name, "sender": "sender-id", "recipient": recipient, name: content}
+
+    return {"use_case": "fallback", "fallback_seconds": "60", "pc": channel(primary), "fc": channel(fallback)}
+
+
+def legacy_decode(body):
+    return json.loads(body.encode().decode("unicode_escape"))
+
+
+def run(name, decode, bodies, payloads, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for body in bodies:
+            decode(body)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    mismatched = 0
+    for body, payload in zip(bodies, payloads):
+        try:
+            if decode(body) != payload:
+                mismatched += 1
+        except ValueError:
+            mismatched += 1
+
+    print(f"{name:<28} {len(bodies) / best:>12,.0f} bodies/s  {best * 1e6 / len(bodies):>8.2f} us/body"
+          f"  {mismatched:>6} / {len(bodies)} corrupted")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=20000, help="number of request bodies to decode")
+    parser.add_argument("--repeat", type=int, default=5, help="timed passes, the best one is reported")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    payloads = [make_payload(rng) for _ in range(args.records)]
+    # API Gateway receives the raw UTF-8 JSON the client posted
+    bodies = [escape_javascript(json.dumps(payload, ensure_ascii=False)) for payload in payloads]
+
+    print(f"{args.records} bodies, average {sum(map(len, bodies)) / len(bodies):.0f} characters\n")
+    run("legacy unicode_escape", legacy_decode, bodies, payloads, args.repeat)
+    # The standard library path is timed with orjson switched off
+    orjson = body_decoder.orjson
+    body_decoder.orjson = None
+    run("body_decoder (json)", body_decoder.decode_body, bodies, payloads, args.repeat)
+    body_decoder.orjson = orjson
+    if orjson is not None:
+        run("body_decoder (orjson)", body_decoder.decode_body, bodies, payloads, args.repeat)
+    else:
+        print("body_decoder (orjson)        skipped, orjson is not installed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Compare the handler bundle as vendored in the repo with the handler code plus the runtime layer.
+
+Two things are measured for PrimaryHandlerLambda:
+
+* size: bytes on disk and zipped, for the handler directory as it used to be
+  deployed versus the trimmed handler asset plus the layer.
+* cold import: a fresh interpreter imports index (which builds the SQS and
+  DynamoDB clients), the way a Lambda init phase does. The vendored bundle is
+  imported without usable bytecode, as on Lambda where the shipped .pyc files
+  do not match the runtime; the layer brings its own bytecode.
+
+The layer is built into a temporary directory with the running interpreter.
+
+    python3 benchmarks/bench_bundle.py --runs 10
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+HANDLER_DIR = os.path.join(ROOT, "lib", "lambdas", "PrimaryHandlerLambda")
+SHARED_DIR = os.path.join(ROOT, "lib", "lambdas", "shared")
+
+sys.path.insert(0, os.path.join(ROOT, "scripts"))
+import build_lambda_layer  # noqa: E402
+
+ENVIRONMENT = {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "DYNAMODB_TABLE_NAME": "MessageTable",
+    "FALLBACK_QUEUE_URL": "https://sqs.us-east-1.amazonaws.com/000000000000/FallbackQueue",
+    "PREWARM_CONNECTIONS": "false",
+}
+
+MEASURE_IMPORT = """
+import sys, time
+start = time.perf_counter()
+import index
+print(time.perf_counter() - start)
+"""
+
+
+def copy_handler_code(destination):
+    # What the CDK asset keeps once the vendored packages are excluded
+    for name in os.listdir(HANDLER_DIR):
+        if name.endswith(".py") and name != "six.py":
+            shutil.copy2(os.path.join(HANDLER_DIR, name), destination)
+
+
+def zipped_size(path, workdir):
+    archive = shutil.make_archive(os.path.join(workdir, "asset"), "zip", path)
+    size = os.path.getsize(archive)
+    os.remove(archive)
+    return size
+
+
+def cold_import(runs, path, extra_env):
+    env = dict(os.environ, **ENVIRONMENT, **extra_env)
+    env["PYTHONPATH"] = os.pathsep.join(path)
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-B", "-c", MEASURE_IMPORT],
+            cwd=path[0], env=env, capture_output=True, text=True, check=True,
+        ).stdout
+        results.append(float(output))
+    return statistics.median(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10, help="fresh interpreters per measurement, the median is reported")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        handler_code = os.path.join(workdir, "handler")
+        os.makedirs(handler_code)
+        copy_handler_code(handler_code)
+        layer = build_lambda_layer.build(
+            build_lambda_layer.DEFAULT_SOURCE, os.path.join(workdir, "layer"), sys.executable)
+
+        # An empty pycache prefix hides any bytecode lying around in the vendored tree
+        empty_prefix = os.path.join(workdir, "pycache")
+        os.makedirs(empty_prefix)
+
+        before_size = build_lambda_layer.directory_size(HANDLER_DIR)
+        after_size = build_lambda_layer.directory_size(handler_code) + build_lambda_layer.directory_size(layer)
+        before_zip = zipped_size(HANDLER_DIR, workdir)
+        after_zip = zipped_size(handler_code, workdir) + zipped_size(layer, workdir)
+
+        before_import = cold_import(args.runs, [HANDLER_DIR, SHARED_DIR], {"PYTHONPYCACHEPREFIX": empty_prefix})
+        after_import = cold_import(args.runs, [handler_code, layer], {})
+
+    print(f"{'':<22} {'on disk':>10} {'zipped':>10} {'cold import':>12}")
+    print(f"  {'vendored bundle':<20} {before_size / 2 ** 20:>7.1f} MB {before_zip / 2 ** 20:>7.1f} MB "
+          f"{before_import * 1000:>9.1f} ms")
+    print(f"  {'handler + layer':<20} {after_size / 2 ** 20:>7.1f} MB {after_zip / 2 ** 20:>7.1f} MB "
+          f"{after_import * 1000:>9.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""Compare the boto3 DynamoDB resource layer with the handlers' message_store.
+
+Three things are measured, each against the botocore/boto3 vendored in
+PrimaryHandlerLambda:
+
+* init: a fresh interpreter builds a DynamoDB Table resource, or the
+  low-level client aws_clients uses; wall time and peak RSS are reported.
+* encode: turning a message item into DynamoDB attribute values with the
+  resource layer's TypeSerializer versus message_store.encode_message_item.
+* put_item: a full put_item call through a stubbed client (no network), so
+  parameter handling, validation and serialization are all included.
+
+    python3 benchmarks/bench_message_store.py --calls 5000
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+HANDLER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib", "lambdas", "PrimaryHandlerLambda")
+SHARED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib", "lambdas", "shared")
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+os.environ.setdefault("DYNAMODB_TABLE_NAME", "MessageTable")
+os.environ["PREWARM_CONNECTIONS"] = "false"
+sys.path.insert(0, HANDLER_DIR)
+sys.path.insert(0, SHARED_DIR)
+
+INIT_SNIPPETS = {
+    "boto3 resource + Table": "import boto3\ntable = boto3.resource('dynamodb').Table('MessageTable')",
+    "botocore client": "import botocore.session\nclient = botocore.session.get_session().create_client('dynamodb')",
+}
+
+MEASURE_INIT = """
+import resource, sys, time
+start = time.perf_counter()
+exec(sys.argv[1])
+elapsed = time.perf_counter() - start
+print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def make_item(index):
+    return {
+        "messageId": f"0100018f-{index:08d}-5b6c-4d1e-9f1a-000000000000",
+        "recipient": "+447700900123",
+        "sender": "+447700900000",
+        "message": str({"message": "Your one-time password is 123456.", "message_type": "TRANSACTIONAL",
+                        "configuration_set": "sms-config-set"}),
+        "primary_channel": "sms",
+        "use_case": "fallback",
+        "status": "sent",
+        "fallback_channel": "email",
+        "pc_message_sent_timestamp": "2024-10-16T09:30:00.000000",
+        "fallback_body": {
+            "channel": "email",
+            "sender": "no-reply@example.com",
+            "recipient": "customer@example.com",
+            "email": {"subject": "Your one-time password", "text": "Your one-time password is 123456.",
+                      "html": "<p>Your one-time password is <b>123456</b>.</p>",
+                      "configuration_set": "ses-config-set"},
+        },
+    }
+
+
+def best_of(repeat, function):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_init(runs):
+    print("init (fresh interpreter, best of %d)" % runs)
+    for name, snippet in INIT_SNIPPETS.items():
+        results = []
+        for _ in range(runs):
+            output = subprocess.run(
+                [sys.executable, "-c", MEASURE_INIT, snippet],
+                cwd=HANDLER_DIR, capture_output=True, text=True, check=True,
+            ).stdout.split()
+            results.append((float(output[0]), int(output[1])))
+        elapsed, rss = min(results)
+        print(f"  {name:<26} {elapsed * 1000:>8.1f} ms  {rss / 1024:>7.1f} MB peak RSS")
+
+
+def bench_encode(items, repeat):
+    from boto3.dynamodb.types import TypeSerializer
+    import message_store
+
+    serializer = TypeSerializer()
+    resource_time = best_of(repeat, lambda: [
+        {key: serializer.serialize(value) for key, value in item.items()} for item in items])
+    client_time = best_of(repeat, lambda: [message_store.encode_message_item(item) for item in items])
+
+    print("encode message item")
+    print(f"  {'TypeSerializer':<26} {resource_time * 1e6 / len(items):>8.2f} us/item")
+    print(f"  {'encode_message_item':<26} {client_time * 1e6 / len(items):>8.2f} us/item")
+
+
+def bench_put_item(items):
+    import boto3
+    from botocore.stub import Stubber
+    import message_store
+
+    table = boto3.resource("dynamodb").Table("MessageTable")
+    client = message_store.dynamodb
+
+    def run(stubbed_client, call):
+        with Stubber(stubbed_client) as stubber:
+            for _ in items:
+                stubber.add_response("put_item", {})
+            start = time.perf_counter()
+            for item in items:
+                call(item)
+            return time.perf_counter() - start
+
+    resource_time = run(table.meta.client, lambda item: table.put_item(Item=item))
+    client_time = run(client, lambda item: client.put_item(
+        TableName=message_store.TABLE_NAME, Item=message_store.encode_message_item(item)))
+
+    print("put_item through a stubbed client")
+    print(f"  {'Table.put_item':<26} {resource_time * 1e6 / len(items):>8.1f} us/call")
+    print(f"  {'client.put_item':<26} {client_time * 1e6 / len(items):>8.1f} us/call")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=5000, help="items encoded and put per measurement")
+    parser.add_argument("--repeat", type=int, default=5, help="timed passes, the best one is reported")
+    args = parser.parse_args()
+
+    items = [make_item(index) for index in range(args.calls)]
+    bench_init(args.repeat)
+    bench_encode(items, args.repeat)
+    bench_put_item(items)
+
+
+if __name__ == "__main__":
+    main()
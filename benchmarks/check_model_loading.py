@@ -0,0 +1,139 @@
+"""Check which botocore service models the primary handler loads per traffic mix.
+
+Channel drivers and their clients are built on first use, so a container
+only loads the service models of the channels it actually sends on. Each
+traffic mix below runs in a fresh interpreter: botocore's Loader is hooked
+before the handler is imported, a batch of broadcast records for the mix's
+channels is handled, and the service models loaded during init and during
+the batch are compared with the expected ones.
+
+    python3 benchmarks/check_model_loading.py [mix ...]
+
+Every AWS endpoint points at a closed local port and each send makes a single
+attempt, so the sends fail fast and nothing leaves the machine. A mix that
+loads a model it should not, or misses one it should, is reported and the
+script exits with status 1.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+HANDLER_DIR = os.path.join(ROOT, "lib", "lambdas", "PrimaryHandlerLambda")
+SHARED_DIR = os.path.join(ROOT, "lib", "lambdas", "shared")
+
+ENVIRONMENT = {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "check",
+    "AWS_SECRET_ACCESS_KEY": "check",
+    "AWS_CONFIG_FILE": os.devnull,
+    "AWS_SHARED_CREDENTIALS_FILE": os.devnull,
+    "AWS_EC2_METADATA_DISABLED": "true",
+    # Every client resolves to a closed port, so a send fails fast instead of reaching AWS
+    "AWS_ENDPOINT_URL": "http://127.0.0.1:9",
+    "PREWARM_CONNECTIONS": "false",
+    "SEND_MAX_ATTEMPTS": "1",
+    "DYNAMODB_TABLE_NAME": "MessageTable",
+    "FALLBACK_QUEUE_URL": "http://127.0.0.1:9/000000000000/FallbackQueue",
+}
+
+# Service models every container loads during init
+INIT_MODELS = {"dynamodb", "sqs"}
+
+CHANNEL_MODELS = {
+    "email": "sesv2",
+    "sms": "pinpoint-sms-voice-v2",
+    "whatsapp": "socialmessaging",
+}
+
+CHANNEL_CONTENT = {
+    "email": {"sender": "sender@example.com", "recipient": "recipient@example.com",
+              "email": {"subject": "Subject", "text": "Text", "html": "<p>Html</p>"}},
+    "sms": {"sender": "+15550000000", "recipient": "+15550000001",
+            "sms": {"message": "Message", "message_type": "TRANSACTIONAL", "configuration_set": "ConfigurationSet"}},
+    "whatsapp": {"sender": "phone-number-id-0", "recipient": "+15550000001",
+                 "whatsapp": {"message": "Message"}},
+}
+
+MIXES = {
+    "none": [],
+    "email": ["email"],
+    "sms": ["sms"],
+    "whatsapp": ["whatsapp"],
+    "email+sms": ["email", "sms"],
+    "all": ["email", "sms", "whatsapp"],
+}
+
+# Runs in the child interpreter. The Loader is hooked before index imports
+# botocore.session, so the models loaded for the module-level clients count.
+MEASURE_MODELS = """
+import json, sys
+import botocore.loaders
+
+loaded = []
+load_service_model = botocore.loaders.Loader.load_service_model
+
+def recording_load_service_model(loader, service_name, type_name, api_version=None):
+    if type_name == 'service-2':
+        loaded.append(service_name)
+    return load_service_model(loader, service_name, type_name, api_version)
+
+botocore.loaders.Loader.load_service_model = recording_load_service_model
+
+import index
+init = sorted(set(loaded))
+index.lambda_handler(json.loads(sys.argv[1]), None)
+
+print(json.dumps({'init': init, 'batch': sorted(set(loaded) - set(init))}))
+"""
+
+
+def make_event(channels):
+    # One broadcast record per channel, broadcast sends on exactly the listed channels
+    records = []
+    for index, channel in enumerate(channels):
+        body = {"use_case": "broadcast", "channels": [dict(CHANNEL_CONTENT[channel], channel=channel)]}
+        records.append({"messageId": f"record-{index}", "body": json.dumps(body)})
+    return {"Records": records}
+
+
+def run_child(channels):
+    env = dict(os.environ, **ENVIRONMENT)
+    env["PYTHONPATH"] = os.pathsep.join([HANDLER_DIR, SHARED_DIR])
+    result = subprocess.run([sys.executable, "-c", MEASURE_MODELS, json.dumps(make_event(channels))],
+                            cwd=HANDLER_DIR, env=env, capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError(f"The primary handler failed:\n{result.stderr}")
+    # The handler prints while it runs, the measurement is the last line
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("mixes", nargs="*", metavar="mix",
+                        help=f"traffic mixes to check (default: all of {', '.join(MIXES)})")
+    args = parser.parse_args()
+    unknown = set(args.mixes) - set(MIXES)
+    if unknown:
+        parser.error(f"unknown mix {', '.join(sorted(unknown))}")
+
+    failed = []
+    for name in args.mixes or MIXES:
+        channels = MIXES[name]
+        result = run_child(channels)
+        expected_batch = sorted({CHANNEL_MODELS[channel] for channel in channels})
+        ok = set(result["init"]) == INIT_MODELS and result["batch"] == expected_batch
+        print(f"{name:<10} init {', '.join(result['init']) or '-':<16} "
+              f"batch {', '.join(result['batch']) or '-':<46} {'ok' if ok else 'UNEXPECTED'}")
+        if not ok:
+            print(f"    expected init {', '.join(sorted(INIT_MODELS))}, batch {', '.join(expected_batch) or '-'}")
+            failed.append(name)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""Measure the init phase of every Lambda and check it against init_budget.json.
+
+Each function's index module is imported in a fresh interpreter, the way the
+Lambda runtime does during init, with stubbed environment variables and every
+AWS endpoint pointed at a closed local port so nothing leaves the machine.
+For each function this records:
+
+* init: wall time of `import index`, module-level client construction included
+* clients: wall time spent in botocore's create_client, per service
+* peak RSS of the interpreter
+* the `-X importtime` tree, from a separate run so it does not skew the timings
+
+The median of --runs measurements is compared with the checked-in budget.
+A function over budget is reported with the import time attributed to the
+top-level packages it loaded and the client construction time per service,
+and the script exits with status 1.
+
+    python3 benchmarks/init_budget.py [--runs 7] [--trees DIR] [--write-budget]
+
+The event processor and the infrastructure function use the boto3 provided by
+the Lambda runtime; here the copy vendored in PrimaryHandlerLambda stands in.
+Bytecode is cached between runs in a temporary pycache prefix, as the runtime
+and the dependency layer ship precompiled; --no-bytecode compiles every run.
+"""
+import argparse
+import json
+import math
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from collections import defaultdict
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+LAMBDAS_DIR = os.path.join(ROOT, "lib", "lambdas")
+BUDGET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "init_budget.json")
+RUNTIME_BOTO3 = os.path.join(LAMBDAS_DIR, "PrimaryHandlerLambda")
+# Shipped to both handlers in the dependency layer
+SHARED_MODULES = os.path.join(LAMBDAS_DIR, "shared")
+
+# Headroom given to measured values by --write-budget
+BUDGET_HEADROOM = 1.5
+
+COMMON_ENVIRONMENT = {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "budget",
+    "AWS_SECRET_ACCESS_KEY": "budget",
+    "AWS_CONFIG_FILE": os.devnull,
+    "AWS_SHARED_CREDENTIALS_FILE": os.devnull,
+    "AWS_EC2_METADATA_DISABLED": "true",
+    # Every client resolves to a closed port, so a stray call fails fast instead of reaching AWS
+    "AWS_ENDPOINT_URL": "http://127.0.0.1:9",
+    "PREWARM_CONNECTIONS": "false",
+}
+
+TABLE_ENVIRONMENT = {"DYNAMODB_TABLE_NAME": "MessageTable"}
+
+FUNCTIONS = {
+    "PrimaryHandlerLambda": {
+        "environment": dict(TABLE_ENVIRONMENT,
+                            FALLBACK_QUEUE_URL="http://127.0.0.1:9/000000000000/FallbackQueue"),
+        "path": [SHARED_MODULES],
+    },
+    "SecondaryHandlerLambda": {"environment": TABLE_ENVIRONMENT, "path": [SHARED_MODULES]},
+    "EventProcessorLambda": {
+        "environment": dict(TABLE_ENVIRONMENT, WHATSAPP_MAPPING="WhatsAppMappingTable"),
+        "path": [RUNTIME_BOTO3],
+    },
+    "EUMInfraLambda": {"environment": {}, "path": [RUNTIME_BOTO3]},
+}
+
+# Runs in the child interpreter. create_client is wrapped as soon as
+# botocore.session is imported, so botocore itself is still loaded by index.
+MEASURE_INIT = """
+import importlib.util, json, resource, sys, time
+
+client_times = []
+
+class WrapCreateClient:
+    def find_spec(self, name, path=None, target=None):
+        if name != 'botocore.session':
+            return None
+        sys.meta_path.remove(self)
+        spec = importlib.util.find_spec(name)
+        exec_module = spec.loader.exec_module
+
+        def exec_and_wrap(module):
+            exec_module(module)
+            create_client = module.Session.create_client
+
+            def timed_create_client(session, service_name, *args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return create_client(session, service_name, *args, **kwargs)
+                finally:
+                    client_times.append((service_name, time.perf_counter() - start))
+
+            module.Session.create_client = timed_create_client
+
+        spec.loader.exec_module = exec_and_wrap
+        return spec
+
+sys.meta_path.insert(0, WrapCreateClient())
+
+start = time.perf_counter()
+import index
+init = time.perf_counter() - start
+
+print(json.dumps({
+    'init': init,
+    'clients': client_times,
+    'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+}))
+"""
+
+
+def run_child(name, pycache_prefix, bytecode, importtime=False):
+    function = FUNCTIONS[name]
+    code_dir = os.path.join(LAMBDAS_DIR, name)
+    env = dict(os.environ, **COMMON_ENVIRONMENT, **function["environment"])
+    env["PYTHONPATH"] = os.pathsep.join([code_dir] + function["path"])
+    env["PYTHONPYCACHEPREFIX"] = pycache_prefix
+    # Whether bytecode is written is decided here, not by the calling shell
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    command = [sys.executable]
+    if not bytecode:
+        command.append("-B")
+    if importtime:
+        command += ["-X", "importtime"]
+    result = subprocess.run(command + ["-c", MEASURE_INIT], cwd=code_dir, env=env,
+                            capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError(f"{name} failed to initialize:\n{result.stderr}")
+    # The function may print during init, the measurement is the last line
+    return json.loads(result.stdout.splitlines()[-1]), result.stderr
+
+
+def parse_importtime(output):
+    # Lines look like "import time:   1234 |   5678 |   package.module", the
+    # module name is indented two spaces per nesting level
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        imports.append((module.strip(), int(self_us), int(cumulative_us)))
+    return imports
+
+
+def attribute_imports(imports):
+    by_package = defaultdict(int)
+    for module, self_us, _ in imports:
+        by_package[module.split(".")[0]] += self_us
+    return sorted(by_package.items(), key=lambda item: item[1], reverse=True)
+
+
+def measure(name, runs, bytecode, workdir):
+    pycache_prefix = os.path.join(workdir, name)
+    if bytecode:
+        # One untimed run fills the bytecode cache
+        run_child(name, pycache_prefix, bytecode)
+
+    samples = [run_child(name, pycache_prefix, bytecode)[0] for _ in range(runs)]
+    _, importtime = run_child(name, pycache_prefix, bytecode, importtime=True)
+
+    clients = defaultdict(list)
+    for sample in samples:
+        per_service = defaultdict(float)
+        for service_name, elapsed in sample["clients"]:
+            per_service[service_name] += elapsed
+        for service_name, elapsed in per_service.items():
+            clients[service_name].append(elapsed)
+
+    return {
+        "init_ms": statistics.median(sample["init"] for sample in samples) * 1000,
+        "clients_ms": statistics.median(
+            sum(elapsed for _, elapsed in sample["clients"]) for sample in samples) * 1000,
+        "peak_rss_mb": statistics.median(sample["peak_rss"] for sample in samples) / 2 ** 20,
+        "client_breakdown": {service_name: statistics.median(times) * 1000
+                             for service_name, times in clients.items()},
+        "importtime": importtime,
+    }
+
+
+def over_budget(result, budget):
+    return [metric for metric, limit in budget.items() if result[metric] > limit]
+
+
+def print_breakdown(result, top):
+    imports = parse_importtime(result["importtime"])
+    print("    import time by top-level package (self time):")
+    for package, self_us in attribute_imports(imports)[:top]:
+        print(f"      {package:<32} {self_us / 1000:>8.1f} ms")
+    print("    client construction:")
+    for service_name, elapsed in sorted(result["client_breakdown"].items(), key=lambda item: -item[1]):
+        print(f"      {service_name:<32} {elapsed:>8.1f} ms")
+
+
+def write_budget(budgets, results):
+    # Functions that were not measured keep their current budget
+    budget = dict(budgets)
+    budget.update({
+        name: {
+            "init_ms": math.ceil(result["init_ms"] * BUDGET_HEADROOM / 10) * 10,
+            "clients_ms": math.ceil(result["clients_ms"] * BUDGET_HEADROOM / 10) * 10,
+            "peak_rss_mb": math.ceil(result["peak_rss_mb"] * BUDGET_HEADROOM / 5) * 5,
+        }
+        for name, result in results.items()
+    })
+    with open(BUDGET_FILE, "w") as budget_file:
+        json.dump(budget, budget_file, indent=2)
+        budget_file.write("\n")
+    print(f"Budget written to {os.path.relpath(BUDGET_FILE)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("functions", nargs="*", metavar="function",
+                        help=f"functions to measure (default: all of {', '.join(FUNCTIONS)})")
+    parser.add_argument("--runs", type=int, default=7, help="fresh interpreters per function, the median is used")
+    parser.add_argument("--trees", metavar="DIR", help="write each function's -X importtime output to DIR")
+    parser.add_argument("--top", type=int, default=8, help="packages listed in a breakdown")
+    parser.add_argument("--verbose", action="store_true", help="print the breakdown of every function")
+    parser.add_argument("--no-bytecode", action="store_true", help="compile every module on every run")
+    parser.add_argument("--write-budget", action="store_true",
+                        help=f"replace the budget with the measurements plus {BUDGET_HEADROOM:g}x headroom")
+    args = parser.parse_args()
+    unknown = set(args.functions) - set(FUNCTIONS)
+    if unknown:
+        parser.error(f"unknown function {', '.join(sorted(unknown))}")
+
+    with open(BUDGET_FILE) as budget_file:
+        budgets = json.load(budget_file)
+
+    results = {}
+    failed = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in args.functions or FUNCTIONS:
+            result = results[name] = measure(name, args.runs, not args.no_bytecode, workdir)
+            if args.trees:
+                os.makedirs(args.trees, exist_ok=True)
+                with open(os.path.join(args.trees, f"{name}.importtime.txt"), "w") as tree_file:
+                    tree_file.write(result["importtime"])
+
+            budget = budgets.get(name, {})
+            exceeded = over_budget(result, budget)
+            status = "OVER BUDGET" if exceeded else "ok" if budget else "no budget"
+            print(f"{name:<30} init {result['init_ms']:>7.1f} ms  clients {result['clients_ms']:>7.1f} ms  "
+                  f"peak RSS {result['peak_rss_mb']:>6.1f} MB  {status}")
+            for metric in exceeded:
+                print(f"    {metric} {result[metric]:.1f} > budget {budget[metric]}")
+            if exceeded:
+                failed.append(name)
+            if exceeded or args.verbose:
+                print_breakdown(result, args.top)
+
+    if args.write_budget:
+        write_budget(budgets, results)
+    elif failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
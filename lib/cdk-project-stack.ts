@@ -35,6 +35,9 @@ export class CdkBackendStack extends Stack {
     const sesConfigSetName = configParams["sesConfigSetName"];
     const createSMSConfigSet = configParams["createSMSConfigSet"];
     const smsConfigSetName = configParams["smsConfigSetName"];
+    const smsMessagesPerSecond = configParams["smsMessagesPerSecond"];
+    const whatsappMessagesPerSecond = configParams["whatsappMessagesPerSecond"];
+    const bufferDeliveryEvents = configParams["bufferDeliveryEvents"];
 
     // DynamoDB table for Message status
     const messageTable = new dynamodb.Table(this, "MessageTable", {
@@ -51,6 +54,21 @@ export class CdkBackendStack extends Stack {
       removalPolicy: RemovalPolicy.RETAIN,
     });
 
+    // DynamoDB table for state shared by every handler container, such as send rate counters
+    const stateTable = new dynamodb.Table(this, "StateTable", {
+      partitionKey: { name: "pk", type: dynamodb.AttributeType.STRING },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      timeToLiveAttribute: "expires_at",
+      removalPolicy: RemovalPolicy.DESTROY,
+    });
+
+    // Send rate settings shared by the message handlers
+    const rateLimitEnvironment = {
+      STATE_TABLE_NAME: stateTable.tableName,
+      SMS_MESSAGES_PER_SECOND: String(smsMessagesPerSecond),
+      WHATSAPP_MESSAGES_PER_SECOND: String(whatsappMessagesPerSecond),
+    };
+
     // SQS Queues
     const dlq = new sqs.Queue(this, "DLQ");
     const primaryQueue = new sqs.Queue(this, "PrimaryQueue", {
@@ -232,21 +250,57 @@ export class CdkBackendStack extends Stack {
       true
     );
 
+    // Runtime dependencies and the modules in lib/lambdas/shared, used by both
+    // handlers and built by scripts/build_lambda_layer.py
+    const runtimeDependenciesLayer = new lambda.LayerVersion(
+      this,
+      "RuntimeDependenciesLayer",
+      {
+        code: lambda.Code.fromAsset("build/lambda-layer"),
+        compatibleRuntimes: [lambda.Runtime.PYTHON_3_12],
+        description: "botocore, its dependencies and the shared modules of the message handlers",
+      }
+    );
+
+    // The vendored packages in the handler directories come from the layer instead
+    const handlerAssetExcludes = [
+      "boto3",
+      "boto3-*",
+      "botocore",
+      "botocore-*",
+      "s3transfer",
+      "s3transfer-*",
+      "urllib3",
+      "urllib3-*",
+      "jmespath",
+      "jmespath-*",
+      "dateutil",
+      "python_dateutil-*",
+      "six.py",
+      "six-*",
+      "bin",
+      "__pycache__",
+    ];
+
     // Primary Message Handler Lambda
     const primaryHandlerLambda = new lambda.Function(
       this,
       "PrimaryHandlerLambda",
       {
         runtime: lambda.Runtime.PYTHON_3_12,
-        code: lambda.Code.fromAsset("lib/lambdas/PrimaryHandlerLambda"),
+        code: lambda.Code.fromAsset("lib/lambdas/PrimaryHandlerLambda", {
+          exclude: handlerAssetExcludes,
+        }),
         handler: "index.lambda_handler",
+        layers: [runtimeDependenciesLayer],
         timeout: Duration.seconds(30),
         memorySize: 256,
         environment: {
           PRIMARY_QUEUE_URL: primaryQueue.queueUrl,
           FALLBACK_QUEUE_URL: fallbackQueue.queueUrl,
           DYNAMODB_TABLE_NAME: messageTable.tableName,
-          SNS_TOPIC_ARN: snsTopic.topicArn
+          SNS_TOPIC_ARN: snsTopic.topicArn,
+          ...rateLimitEnvironment,
         },
       }
     );
@@ -257,61 +311,36 @@ export class CdkBackendStack extends Stack {
       "SecondaryHandlerLambda",
       {
         runtime: lambda.Runtime.PYTHON_3_12,
-        code: lambda.Code.fromAsset("lib/lambdas/SecondaryHandlerLambda"),
-        handler: "index.lambda_handler",
-        timeout: Duration.seconds(30),
-        memorySize: 256,
-        environment: {
-          DYNAMODB_TABLE_NAME: messageTable.tableName,
-        },
-      }
-    );
-
-    // Email Event Processor Lambda
-    const emailEventProcessorLambda = new lambda.Function(
-      this,
-      "EmailEventProcessorLambda",
-      {
-        runtime: lambda.Runtime.PYTHON_3_12,
-        code: lambda.Code.fromAsset("lib/lambdas/EmailEventProcessorLambda"),
-        handler: "index.lambda_handler",
-        timeout: Duration.seconds(30),
-        memorySize: 256,
-        environment: {
-          DYNAMODB_TABLE_NAME: messageTable.tableName,
-        },
-      }
-    );
-
-    // SMS Event Processor Lambda
-    const smsEventProcessorLambda = new lambda.Function(
-      this,
-      "SMSEventProcessorLambda",
-      {
-        runtime: lambda.Runtime.PYTHON_3_12,
-        code: lambda.Code.fromAsset("lib/lambdas/SMSEventProcessorLambda"),
+        code: lambda.Code.fromAsset("lib/lambdas/SecondaryHandlerLambda", {
+          exclude: handlerAssetExcludes,
+        }),
         handler: "index.lambda_handler",
+        layers: [runtimeDependenciesLayer],
         timeout: Duration.seconds(30),
         memorySize: 256,
         environment: {
+          FALLBACK_QUEUE_URL: fallbackQueue.queueUrl,
           DYNAMODB_TABLE_NAME: messageTable.tableName,
+          ...rateLimitEnvironment,
         },
       }
     );
 
-    // WhatsApp Event Processor Lambda
-    const whatsappEventProcessorLambda = new lambda.Function(
+    // Event Processor Lambda, handles the Email, SMS and WhatsApp events
+    const eventProcessorLambda = new lambda.Function(
       this,
-      "WhatsAppEventProcessorLambda",
+      "EventProcessorLambda",
       {
         runtime: lambda.Runtime.PYTHON_3_12,
-        code: lambda.Code.fromAsset("lib/lambdas/WhatsAppEventProcessorLambda"),
+        code: lambda.Code.fromAsset("lib/lambdas/EventProcessorLambda"),
         handler: "index.lambda_handler",
         timeout: Duration.seconds(30),
         memorySize: 256,
         environment: {
           DYNAMODB_TABLE_NAME: messageTable.tableName,
           WHATSAPP_MAPPING: whatsappMappingTable.tableName,
+          STATE_TABLE_NAME: stateTable.tableName,
+          FALLBACK_QUEUE_URL: fallbackQueue.queueUrl,
         },
       }
     );
@@ -319,9 +348,7 @@ export class CdkBackendStack extends Stack {
     // Grant KMS Decrypt permissions to Lambda
     kmsKey.grantDecrypt(primaryHandlerLambda);
     kmsKey.grantDecrypt(secondaryHandlerLambda);
-    kmsKey.grantDecrypt(emailEventProcessorLambda);
-    kmsKey.grantDecrypt(smsEventProcessorLambda);
-    kmsKey.grantDecrypt(whatsappEventProcessorLambda);
+    kmsKey.grantDecrypt(eventProcessorLambda);
 
     // Grant DynamoDB and SQS permissions for primaryHandlerLambda
     //messageTable.grantReadWriteData(primaryHandlerLambda);
@@ -333,6 +360,9 @@ export class CdkBackendStack extends Stack {
           "kms:Decrypt",
           "ses:SendEmail",
           "ses:SendTemplatedEmail",
+          "ses:SendBulkEmail",
+          "ses:GetEmailTemplate",
+          "ses:GetAccount",
           "sms-voice:SendTextMessage",
           "social-messaging:SendWhatsAppMessage"
         ],
@@ -346,6 +376,7 @@ export class CdkBackendStack extends Stack {
         actions: [
           "sqs:SendMessage",
           "dynamodb:PutItem",
+          "dynamodb:BatchWriteItem",
           "dynamodb:UpdateItem",
           "dynamodb:GetItem",
         ],
@@ -354,6 +385,14 @@ export class CdkBackendStack extends Stack {
       })
     );
 
+    primaryHandlerLambda.addToRolePolicy(
+      new iam.PolicyStatement({
+        actions: ["dynamodb:UpdateItem", "dynamodb:BatchGetItem"],
+        effect: iam.Effect.ALLOW,
+        resources: [stateTable.tableArn],
+      })
+    );
+
     // Grant DynamoDB and SQS permissions for secondaryHandlerLambda
     //messageTable.grantReadWriteData(secondaryHandlerLambda);
     //fallbackQueue.grantConsumeMessages(secondaryHandlerLambda);
@@ -364,6 +403,8 @@ export class CdkBackendStack extends Stack {
           "kms:Decrypt",
           "ses:SendEmail",
           "ses:SendTemplatedEmail",
+          "ses:SendBulkEmail",
+          "ses:GetAccount",
           "sms-voice:SendTextMessage",
           "social-messaging:SendWhatsAppMessage"
         ],
@@ -378,7 +419,9 @@ export class CdkBackendStack extends Stack {
           "sqs:ReceiveMessage",
           "sqs:DeleteMessage",
           "sqs:GetQueueAttributes",
+          "sqs:SendMessage",
           "dynamodb:GetItem",
+          "dynamodb:BatchGetItem",
           "dynamodb:UpdateItem",
         ],
         effect: iam.Effect.ALLOW,
@@ -386,83 +429,123 @@ export class CdkBackendStack extends Stack {
       })
     );
 
-    // Grant DynamoDB permission for Email, SMS and WhatsApp eventProcessorLambdas
-    //messageTable.grantReadWriteData(emailEventProcessorLambda);
-    //messageTable.grantReadWriteData(smsEventProcessorLambda);
-    //messageTable.grantReadWriteData(whatsappEventProcessorLambda);
-    //whatsappMappingTable.grantReadWriteData(whatsappEventProcessorLambda);
-
-    emailEventProcessorLambda.addToRolePolicy(
+    secondaryHandlerLambda.addToRolePolicy(
       new iam.PolicyStatement({
-        actions: ["dynamodb:GetItem", "dynamodb:UpdateItem"],
+        actions: ["dynamodb:UpdateItem"],
         effect: iam.Effect.ALLOW,
-        resources: [messageTable.tableArn, fallbackQueue.queueArn],
+        resources: [stateTable.tableArn],
       })
     );
 
-    smsEventProcessorLambda.addToRolePolicy(
+    // Grant DynamoDB permission for eventProcessorLambda
+    //messageTable.grantReadWriteData(eventProcessorLambda);
+    //whatsappMappingTable.grantReadWriteData(eventProcessorLambda);
+
+    eventProcessorLambda.addToRolePolicy(
       new iam.PolicyStatement({
-        actions: ["dynamodb:GetItem", "dynamodb:UpdateItem"],
+        actions: [
+          "dynamodb:GetItem",
+          "dynamodb:BatchGetItem",
+          "dynamodb:UpdateItem",
+          "dynamodb:PutItem",
+          "dynamodb:BatchWriteItem",
+          "sqs:SendMessage",
+        ],
         effect: iam.Effect.ALLOW,
-        resources: [messageTable.tableArn, fallbackQueue.queueArn],
+        resources: [messageTable.tableArn, whatsappMappingTable.tableArn, fallbackQueue.queueArn],
       })
     );
 
-    whatsappEventProcessorLambda.addToRolePolicy(
+    // Delivery outcomes counted for the primary handler's circuit breaker,
+    // and the optional ledger of processed events
+    eventProcessorLambda.addToRolePolicy(
       new iam.PolicyStatement({
-        actions: ["dynamodb:GetItem", "dynamodb:UpdateItem", "dynamodb:PutItem"],
+        actions: ["dynamodb:UpdateItem", "dynamodb:PutItem", "dynamodb:DeleteItem"],
         effect: iam.Effect.ALLOW,
-        resources: [messageTable.tableArn, whatsappMappingTable.tableArn, fallbackQueue.queueArn],
+        resources: [stateTable.tableArn],
       })
     );
 
-    // Subscribe Email, SMS and WhatsApp processor Lambdas to SNS
-    snsTopic.addSubscription(
-      new subscriptions.LambdaSubscription(smsEventProcessorLambda, {
-        filterPolicyWithMessageBody: {
-          context: sns.FilterOrPolicy.policy({
-            message_type: sns.FilterOrPolicy.filter(
-              sns.SubscriptionFilter.stringFilter({
-                allowlist: ["primary"],
-              })
-            ),
-          }),
+    // Only the events that change a message's status reach the event
+    // processor: delivery and failure events of primary Email and SMS messages,
+    // and WhatsApp status webhooks. Keep the event types in sync with the
+    // routing table in lib/lambdas/EventProcessorLambda/index.py.
+    const emailEventTypes = ["Delivery", "Bounce", "Reject", "RenderingFailure"];
+    const smsEventTypes = [
+      "TEXT_SUCCESSFUL",
+      "TEXT_DELIVERED",
+      "TEXT_BLOCKED",
+      "TEXT_CARRIER_BLOCKED",
+      "TEXT_CARRIER_UNREACHABLE",
+      "TEXT_INVALID",
+      "TEXT_INVALID_MESSAGE",
+      "TEXT_PROTECTIVE_OPERATOR_BLOCKED",
+      "TEXT_SPAM",
+      "TEXT_TTL_EXPIRED",
+      "TEXT_UNKNOWN",
+      "TEXT_UNREACHABLE",
+    ];
+    // The typed filter policy has no $or, it is set on the CfnSubscription
+    const eventFilterPolicy = {
+      $or: [
+        {
+          mail: { tags: { message_type: ["primary"] } },
+          eventType: emailEventTypes,
         },
-      })
-    );
-
-    snsTopic.addSubscription(
-      new subscriptions.LambdaSubscription(emailEventProcessorLambda, {
-        filterPolicyWithMessageBody: {
-          mail: sns.FilterOrPolicy.policy({
-            tags: sns.FilterOrPolicy.policy({
-              message_type: sns.FilterOrPolicy.filter(
-                sns.SubscriptionFilter.stringFilter({
-                  allowlist: ["primary"],
-                })
-              ),
-            }),
-          }),
+        {
+          context: { message_type: ["primary"] },
+          eventType: smsEventTypes,
         },
-      })
-    );
+        {
+          whatsAppWebhookEntry: [{ exists: true }],
+        },
+      ],
+    };
 
-    snsTopic.addSubscription(
-      new subscriptions.LambdaSubscription(whatsappEventProcessorLambda, {
-        filterPolicyWithMessageBody: {
-          whatsAppWebhookEntry: sns.FilterOrPolicy.filter(
-            sns.SubscriptionFilter.existsFilter()
-          ),
+    // Subscribe the event processor Lambda to SNS. With bufferDeliveryEvents
+    // the events go through an SQS queue and are processed in batches instead
+    // of one invocation each.
+    let eventSubscription: sns.Subscription;
+    if (bufferDeliveryEvents != "true") {
+      eventSubscription = snsTopic.addSubscription(
+        new subscriptions.LambdaSubscription(eventProcessorLambda)
+      );
+    } else {
+      const eventQueue = new sqs.Queue(this, "DeliveryEventQueue", {
+        visibilityTimeout: Duration.seconds(180),
+        enforceSSL: true,
+        deadLetterQueue: {
+          queue: dlq,
+          maxReceiveCount: 5,
         },
-      })
-    );
+      });
+      eventSubscription = snsTopic.addSubscription(
+        new subscriptions.SqsSubscription(eventQueue, {
+          rawMessageDelivery: true,
+        })
+      );
+      eventProcessorLambda.addEventSource(
+        new eventsources.SqsEventSource(eventQueue, {
+          batchSize: 100,
+          maxBatchingWindow: Duration.seconds(5),
+          reportBatchItemFailures: true,
+        })
+      );
+    }
+    const cfnEventSubscription = eventSubscription.node.defaultChild as sns.CfnSubscription;
+    cfnEventSubscription.filterPolicy = eventFilterPolicy;
+    cfnEventSubscription.filterPolicyScope = "MessageBody";
 
     // Add Lambda triggers for the SQS queues
     primaryHandlerLambda.addEventSource(
-      new eventsources.SqsEventSource(primaryQueue)
+      new eventsources.SqsEventSource(primaryQueue, {
+        reportBatchItemFailures: true,
+      })
     );
     secondaryHandlerLambda.addEventSource(
-      new eventsources.SqsEventSource(fallbackQueue)
+      new eventsources.SqsEventSource(fallbackQueue, {
+        reportBatchItemFailures: true,
+      })
     );
 
     /**************************************************************************************************************
@@ -600,8 +683,7 @@ export class CdkBackendStack extends Stack {
     // Add suppressions for all Lambda functions
     const lambdaFunctions = [
       primaryHandlerLambda,
-      emailEventProcessorLambda,
-      smsEventProcessorLambda,
+      eventProcessorLambda,
       secondaryHandlerLambda,
       SMSInfraLambda,
     ];
@@ -0,0 +1,561 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+import boto3
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import BotoCoreError, ClientError
+
+# Low-level client with pre-encoded attribute values, no resource layer
+dynamodb = boto3.client("dynamodb")
+sqs = boto3.client("sqs")
+deserializer = TypeDeserializer()
+TABLE_NAME = os.environ["DYNAMODB_TABLE_NAME"]
+WHATSAPP_MAPPING_TABLE = os.environ["WHATSAPP_MAPPING"]
+STATUS_DELIVERED = {"S": "delivered"}
+STATUS_SENT = {"S": "sent"}
+STATUS_FAILED = {"S": "failed"}
+STATUS_SENT_FALLBACK = {"S": "sent_fallback"}
+STATE_TABLE_NAME = os.environ.get("STATE_TABLE_NAME")
+
+# Hard failures start the fallback right away through this queue
+FALLBACK_QUEUE_URL = os.environ.get("FALLBACK_QUEUE_URL")
+
+# The status updates of a batch are written side by side
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", "10"))
+executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+
+# BatchGetItem accepts at most 100 keys per call, BatchWriteItem 25 put requests
+MAX_BATCH_GET_SIZE = 100
+MAX_BATCH_WRITE_SIZE = 25
+MAX_ATTEMPTS = 5
+BASE_BACKOFF_SECONDS = 0.05
+
+# Delivery outcomes feed the primary handler's circuit breaker
+BREAKER_WINDOW_SECONDS = 60
+BREAKER_WINDOW_TTL_SECONDS = 3600
+
+# The event types that change a message's status. The SNS subscription only
+# lets these through, keep its filter policy in lib/cdk-project-stack.ts in sync.
+EMAIL_DELIVERED_EVENT_TYPES = {"Delivery"}
+EMAIL_UNDELIVERED_EVENT_TYPES = {"Bounce", "Reject", "RenderingFailure"}
+# TEXT_SUCCESSFUL only means the carrier accepted the message
+SMS_ACCEPTED_EVENT_TYPES = {"TEXT_SUCCESSFUL"}
+SMS_DELIVERED_EVENT_TYPES = {"TEXT_DELIVERED"}
+SMS_UNDELIVERED_EVENT_TYPES = {
+    "TEXT_BLOCKED",
+    "TEXT_CARRIER_BLOCKED",
+    "TEXT_CARRIER_UNREACHABLE",
+    "TEXT_INVALID",
+    "TEXT_INVALID_MESSAGE",
+    "TEXT_PROTECTIVE_OPERATOR_BLOCKED",
+    "TEXT_SPAM",
+    "TEXT_TTL_EXPIRED",
+    "TEXT_UNKNOWN",
+    "TEXT_UNREACHABLE",
+}
+
+# Outcomes of the running invocation, written once per channel and sender
+delivery_outcomes = Counter()
+outcomes_lock = threading.Lock()
+
+# Fingerprints of the events this container processed, least recent first.
+# SNS delivers at least once and providers retry webhooks, an event seen
+# before costs no DynamoDB call.
+MAX_SEEN_EVENTS = int(os.environ.get("MAX_SEEN_EVENTS", "10000"))
+seen_events = OrderedDict()
+
+# With a TTL every event is also claimed in the state table, so a duplicate
+# delivered to another container is skipped as well. An invocation that dies
+# before releasing its failed events leaves their claims to expire, keep the
+# TTL below the visibility timeout of the delivery event queue.
+EVENT_LEDGER_TTL_SECONDS = int(os.environ.get("EVENT_LEDGER_TTL_SECONDS", "0"))
+EVENT_LEDGER_ENABLED = STATE_TABLE_NAME is not None and EVENT_LEDGER_TTL_SECONDS > 0
+
+
+def lambda_handler(event, context):
+    # Email, SMS and WhatsApp events arrive one per invocation from SNS, or in
+    # batches from the SQS queue subscribed to the topic
+    fingerprints = {}
+    for record in event["Records"]:
+        fingerprint = event_fingerprint(record)
+        if fingerprint in seen_events:
+            seen_events.move_to_end(fingerprint)
+        elif fingerprint not in fingerprints:
+            fingerprints[fingerprint] = event_record_id(record)
+    fingerprints = {record_id: fingerprint for fingerprint, record_id in claim_events(fingerprints).items()}
+
+    updates = []
+    whatsapp_statuses = []
+    for record in event["Records"]:
+        record_id = event_record_id(record)
+        if record_id not in fingerprints:
+            continue
+        try:
+            message = json.loads(event_message(record))
+            if "whatsAppWebhookEntry" in message:
+                whatsapp_statuses.extend(
+                    (record_id,) + status for status in webhook_statuses(message)
+                )
+                continue
+            route = ROUTES.get((event_source(message), message["eventType"]))
+            if route is not None:
+                updates.append((record_id,) + route(message))
+        except Exception as e:
+            # A malformed event does not parse on a retry either
+            print(f"Error parsing event {record_id}: {str(e)}")
+
+    failed_record_ids = []
+    try:
+        updates += whatsapp_status_updates(whatsapp_statuses)
+    except Exception as e:
+        print(f"Error resolving WhatsApp message IDs: {str(e)}")
+        failed_record_ids = [record_id for record_id, _, _, _ in whatsapp_statuses]
+
+    updates = coalesce_updates(updates)
+    failed_record_ids = list(dict.fromkeys(failed_record_ids + apply_updates(updates)))
+    flush_delivery_outcomes()
+    remember_events(fingerprints, failed_record_ids)
+    duplicates = len(event["Records"]) - len(fingerprints)
+    print(f"Processed {len(event['Records'])} events, {duplicates} duplicates, "
+          f"{len(updates)} status updates, {len(failed_record_ids)} failed")
+
+    # Only used by the SQS subscription, the failed events are received again
+    return {
+        "batchItemFailures": [{"itemIdentifier": record_id} for record_id in failed_record_ids]
+    }
+
+
+def event_record_id(record):
+    return record["Sns"]["MessageId"] if "Sns" in record else record["messageId"]
+
+
+def event_message(record):
+    # SNS wraps the event, the SQS subscription delivers it raw
+    return record["Sns"]["Message"] if "Sns" in record else record["body"]
+
+
+def event_fingerprint(record):
+    # Redeliveries carry the same event under a new delivery ID
+    return hashlib.sha256(event_message(record).encode()).hexdigest()
+
+
+def claim_events(fingerprints):
+    # Returns the events no other container claimed, as fingerprint: record ID.
+    # An event claimed elsewhere is skipped but not remembered: the other
+    # container may fail and release it, and its redelivery must not be taken
+    # for a duplicate here.
+    if not EVENT_LEDGER_ENABLED:
+        return fingerprints
+    claims = executor.map(claim_event, fingerprints)
+    return {
+        fingerprint: record_id
+        for (fingerprint, record_id), new in zip(fingerprints.items(), claims)
+        if new
+    }
+
+
+def claim_event(fingerprint):
+    now = int(time.time())
+    try:
+        dynamodb.put_item(
+            TableName=STATE_TABLE_NAME,
+            Item={
+                "pk": {"S": f"event#{fingerprint}"},
+                "expires_at": {"N": str(now + EVENT_LEDGER_TTL_SECONDS)},
+            },
+            # Expired claims may not have been deleted by TTL yet
+            ConditionExpression="attribute_not_exists(pk) OR #expires_at < :now",
+            ExpressionAttributeNames={"#expires_at": "expires_at"},
+            ExpressionAttributeValues={":now": {"N": str(now)}},
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return False
+        # The status updates are conditional, processing a duplicate is safe
+        print(f"Error claiming event {fingerprint}: {str(e)}")
+    except BotoCoreError as e:
+        print(f"Error claiming event {fingerprint}: {str(e)}")
+    return True
+
+
+def release_event(fingerprint):
+    try:
+        dynamodb.delete_item(
+            TableName=STATE_TABLE_NAME,
+            Key={"pk": {"S": f"event#{fingerprint}"}},
+        )
+    except (ClientError, BotoCoreError) as e:
+        print(f"Error releasing event {fingerprint}: {str(e)}")
+
+
+def remember_events(fingerprints, failed_record_ids):
+    # Failed events are received again and must not be taken for duplicates
+    failed_record_ids = set(failed_record_ids)
+    for record_id, fingerprint in fingerprints.items():
+        if record_id not in failed_record_ids:
+            remember_event(fingerprint)
+        elif EVENT_LEDGER_ENABLED:
+            release_event(fingerprint)
+
+
+def remember_event(fingerprint):
+    seen_events[fingerprint] = True
+    seen_events.move_to_end(fingerprint)
+    while len(seen_events) > MAX_SEEN_EVENTS:
+        seen_events.popitem(last=False)
+
+
+def event_source(message):
+    # SES events carry the mail object, End User Messaging SMS events do not
+    return "email" if "mail" in message else "sms"
+
+
+def email_delivered(ses_event):
+    return (mark_delivered, ses_event["mail"]["messageId"])
+
+
+def email_undelivered(ses_event):
+    message_id = ses_event["mail"]["messageId"]
+    # SES may still deliver after a transient bounce
+    if ses_event["eventType"] == "Bounce" and ses_event["bounce"]["bounceType"] != "Permanent":
+        return (record_undelivered, message_id)
+    return (start_fallback, message_id)
+
+
+def sms_accepted(sms_event):
+    return (mark_accepted, sms_event["messageId"])
+
+
+def sms_delivered(sms_event):
+    return (mark_delivered, sms_event["messageId"])
+
+
+def sms_undelivered(sms_event):
+    # Every undelivered SMS event type is final
+    return (start_fallback, sms_event["messageId"])
+
+
+# Status update of every event source and type, events that are not listed
+# need none. Each route returns the update and the message it applies to.
+ROUTES = {
+    **{("email", event_type): email_delivered for event_type in EMAIL_DELIVERED_EVENT_TYPES},
+    **{("email", event_type): email_undelivered for event_type in EMAIL_UNDELIVERED_EVENT_TYPES},
+    **{("sms", event_type): sms_accepted for event_type in SMS_ACCEPTED_EVENT_TYPES},
+    **{("sms", event_type): sms_delivered for event_type in SMS_DELIVERED_EVENT_TYPES},
+    **{("sms", event_type): sms_undelivered for event_type in SMS_UNDELIVERED_EVENT_TYPES},
+}
+
+
+def webhook_statuses(whatsapp_event):
+    # Meta batches several changes and statuses into one webhook entry, every
+    # one of them is returned as (aws_msg_id, status, whatsapp_msg_id)
+    webhook_entry = json.loads(whatsapp_event["whatsAppWebhookEntry"])
+    statuses = []
+    for change in webhook_entry.get("changes", []):
+        if change.get("field") != "messages":
+            continue
+        for status in change.get("value", {}).get("statuses", []):
+            # The WhatsApp message ID may not be present
+            statuses.append((whatsapp_event.get("messageId"), status["status"], status.get("id")))
+    return statuses
+
+
+def whatsapp_status_updates(statuses):
+    # Accepted statuses map the WhatsApp message ID to the AWS one, later
+    # statuses only carry the WhatsApp message ID. The mappings of the batch
+    # are read and written together, accepted statuses first so a later
+    # status in the same batch finds its mapping.
+    accepted = [(aws_msg_id, whatsapp_msg_id) for _, aws_msg_id, status, whatsapp_msg_id in statuses
+                if status == "accepted" and aws_msg_id and whatsapp_msg_id]
+    tracked = {item["messageId"]["S"] for item in batch_get(
+        TABLE_NAME, "messageId", [aws_msg_id for aws_msg_id, _ in accepted], "messageId")}
+    mappings = {whatsapp_msg_id: aws_msg_id for aws_msg_id, whatsapp_msg_id in accepted if aws_msg_id in tracked}
+    for aws_msg_id, _ in accepted:
+        if aws_msg_id not in tracked:
+            print(f"Item with aws_msg_id {aws_msg_id} does not exist in message_status_table.")
+    put_mappings(mappings)
+
+    unmapped = [whatsapp_msg_id for _, _, status, whatsapp_msg_id in statuses
+                if status in ("delivered", "failed") and whatsapp_msg_id and whatsapp_msg_id not in mappings]
+    for item in batch_get(WHATSAPP_MAPPING_TABLE, "whatsapp_msg_id", unmapped, "whatsapp_msg_id, aws_msg_id"):
+        mappings[item["whatsapp_msg_id"]["S"]] = item["aws_msg_id"]["S"]
+
+    updates = []
+    for record_id, aws_msg_id, status, whatsapp_msg_id in statuses:
+        if status == "delivered":
+            if whatsapp_msg_id in mappings:
+                updates.append((record_id, mark_delivered, mappings[whatsapp_msg_id]))
+            else:
+                print(f"Item with whatsapp_msg_id {whatsapp_msg_id} does not exist in whatsapp_mapping_table.")
+        elif status == "failed":
+            aws_msg_id = mappings.get(whatsapp_msg_id, aws_msg_id)
+            if aws_msg_id:
+                updates.append((record_id, start_fallback, aws_msg_id))
+            else:
+                print("Failure event without AWS message ID, no further action.")
+    return updates
+
+
+def batch_get(table_name, key_name, ids, projection):
+    # Reads the items of the given IDs with as few calls as possible
+    items = []
+    ids = list(dict.fromkeys(ids))
+    for start in range(0, len(ids), MAX_BATCH_GET_SIZE):
+        request = {
+            table_name: {
+                "Keys": [{key_name: {"S": item_id}} for item_id in ids[start:start + MAX_BATCH_GET_SIZE]],
+                "ProjectionExpression": projection,
+            }
+        }
+        for attempt in range(MAX_ATTEMPTS):
+            if attempt:
+                time.sleep(BASE_BACKOFF_SECONDS * 2 ** (attempt - 1))
+            response = dynamodb.batch_get_item(RequestItems=request)
+            items.extend(response["Responses"].get(table_name, []))
+            # Throttled or capacity-limited reads come back to be sent again
+            request = response.get("UnprocessedKeys", {})
+            if not request:
+                break
+        if request:
+            raise Exception(f"Could not read every item from {table_name}")
+    return items
+
+
+def put_mappings(mappings):
+    requests = [
+        {"PutRequest": {"Item": {"whatsapp_msg_id": {"S": whatsapp_msg_id}, "aws_msg_id": {"S": aws_msg_id}}}}
+        for whatsapp_msg_id, aws_msg_id in mappings.items()
+    ]
+    for start in range(0, len(requests), MAX_BATCH_WRITE_SIZE):
+        pending = requests[start:start + MAX_BATCH_WRITE_SIZE]
+        for attempt in range(MAX_ATTEMPTS):
+            if attempt:
+                time.sleep(BASE_BACKOFF_SECONDS * 2 ** (attempt - 1))
+            response = dynamodb.batch_write_item(RequestItems={WHATSAPP_MAPPING_TABLE: pending})
+            pending = response.get("UnprocessedItems", {}).get(WHATSAPP_MAPPING_TABLE, [])
+            if not pending:
+                break
+        if pending:
+            raise Exception("Could not store every WhatsApp message ID mapping")
+    if mappings:
+        print(f"Stored {len(mappings)} WhatsApp message ID mappings")
+
+
+def coalesce_updates(updates):
+    # A message often has several events in one batch, such as TEXT_SUCCESSFUL
+    # and TEXT_DELIVERED. Only the update of highest precedence is applied, on
+    # behalf of every record that asked for one.
+    coalesced = {}
+    for record_id, action, message_id in updates:
+        record_ids, current = coalesced.get(message_id, ([], action))
+        if UPDATE_PRECEDENCE[action] < UPDATE_PRECEDENCE[current]:
+            current = action
+        record_ids.append(record_id)
+        coalesced[message_id] = (record_ids, current)
+    return [(record_ids, action, message_id) for message_id, (record_ids, action) in coalesced.items()]
+
+
+def apply_updates(updates):
+    # Every update is its own conditional write. Returns the records whose
+    # update failed and is worth another attempt.
+    results = executor.map(lambda update: update[1](update[2]), updates)
+    failed_record_ids = []
+    for (record_ids, _, _), applied in zip(updates, results):
+        if not applied:
+            failed_record_ids.extend(record_ids)
+    return list(dict.fromkeys(failed_record_ids))
+
+
+def mark_delivered(message_id):
+    # The recipient has the message
+    return set_delivered(message_id, True)
+
+
+def mark_accepted(message_id):
+    # The carrier took the message. Many carriers send no delivery receipt,
+    # so it counts as delivered until a final failure says otherwise.
+    return set_delivered(message_id, False)
+
+
+def set_delivered(message_id, confirmed):
+    # A message fallen back or delivered for certain is not written again,
+    # an unconfirmed delivery does not overwrite a failure either
+    values = {
+        ":delivered": STATUS_DELIVERED,
+        ":sent_fallback": STATUS_SENT_FALLBACK,
+        ":confirmed": {"BOOL": confirmed},
+    }
+    if confirmed:
+        condition = "#status <> :sent_fallback AND (#status <> :delivered OR #confirmed = :unconfirmed)"
+        values[":unconfirmed"] = {"BOOL": False}
+    else:
+        condition = "NOT #status IN (:delivered, :sent_fallback, :failed)"
+        values[":failed"] = STATUS_FAILED
+    try:
+        response = dynamodb.update_item(
+            TableName=TABLE_NAME,
+            Key={"messageId": {"S": message_id}},
+            UpdateExpression="SET #status = :delivered, #confirmed = :confirmed",
+            ConditionExpression="attribute_exists(messageId) AND " + condition,
+            ExpressionAttributeNames={"#status": "status", "#confirmed": "delivery_confirmed"},
+            ExpressionAttributeValues=values,
+            ReturnValues="ALL_OLD",
+            ReturnValuesOnConditionCheckFailure="ALL_OLD",
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            print(f"Error updating DynamoDB: {str(e)}")
+            return False
+        item = e.response.get("Item")
+        if item is None:
+            print(f"Item with messageId {message_id} does not exist")
+        elif item["status"] == STATUS_SENT_FALLBACK:
+            # Delivered after its fallback was sent, the outcome still counts
+            record_delivery_outcome(item, True)
+        return True
+    except BotoCoreError as e:
+        print(f"Error updating DynamoDB: {str(e)}")
+        return False
+    # A confirmation of an accepted message is not counted twice
+    if response["Attributes"]["status"] != STATUS_DELIVERED:
+        record_delivery_outcome(response["Attributes"], True)
+    return True
+
+
+def record_delivery_outcome(item, delivered):
+    # Counted per primary channel and sender for the primary handler's
+    # circuit breaker, see flush_delivery_outcomes
+    if STATE_TABLE_NAME is None or "primary_channel" not in item:
+        return
+    outcome = "delivered" if delivered else "undelivered"
+    with outcomes_lock:
+        delivery_outcomes[(item["primary_channel"]["S"], item["sender"]["S"], outcome)] += 1
+
+
+def flush_delivery_outcomes():
+    # Adds the invocation's outcomes to the windows the circuit breaker reads,
+    # one write per primary channel and sender
+    with outcomes_lock:
+        outcomes = dict(delivery_outcomes)
+        delivery_outcomes.clear()
+
+    totals = {}
+    for (channel, sender, outcome), count in outcomes.items():
+        totals.setdefault((channel, sender), {})[outcome] = count
+
+    window = int(time.time()) // BREAKER_WINDOW_SECONDS * BREAKER_WINDOW_SECONDS
+    for (channel, sender), counts in totals.items():
+        names = {"#window": "window", "#expires_at": "expires_at"}
+        values = {
+            ":window": {"N": str(window)},
+            ":expires_at": {"N": str(window + BREAKER_WINDOW_TTL_SECONDS)},
+        }
+        additions = []
+        for outcome, count in counts.items():
+            names["#" + outcome] = outcome
+            values[":" + outcome] = {"N": str(count)}
+            additions.append(f"#{outcome} :{outcome}")
+        try:
+            dynamodb.update_item(
+                TableName=STATE_TABLE_NAME,
+                Key={"pk": {"S": f"breaker#{channel}#{sender}#{window}"}},
+                UpdateExpression="ADD " + ", ".join(additions) + " SET #window = :window, #expires_at = :expires_at",
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+            )
+        except (ClientError, BotoCoreError) as e:
+            print(f"Error recording delivery outcome: {str(e)}")
+
+
+def record_undelivered(message_id):
+    # Only primary channel messages are tracked, other ids are not found
+    try:
+        response = dynamodb.get_item(
+            TableName=TABLE_NAME,
+            Key={"messageId": {"S": message_id}},
+            ProjectionExpression="primary_channel, sender",
+        )
+    except (ClientError, BotoCoreError) as e:
+        # The event is received again to be counted
+        print(f"Error reading message {message_id}: {str(e)}")
+        return False
+    if "Item" in response:
+        record_delivery_outcome(response["Item"], False)
+    return True
+
+
+def start_fallback(message_id):
+    # The primary message will not be delivered, its fallback is sent now
+    # instead of after fallback_seconds. Only a message still waiting for its
+    # fallback, or only accepted by the carrier, is marked failed, so a
+    # repeated event does not send it twice.
+    try:
+        response = dynamodb.update_item(
+            TableName=TABLE_NAME,
+            Key={"messageId": {"S": message_id}},
+            UpdateExpression="SET #status = :failed",
+            ConditionExpression="#status = :sent OR (#status = :delivered AND #confirmed = :unconfirmed)",
+            ExpressionAttributeNames={"#status": "status", "#confirmed": "delivery_confirmed"},
+            ExpressionAttributeValues={
+                ":failed": STATUS_FAILED,
+                ":sent": STATUS_SENT,
+                ":delivered": STATUS_DELIVERED,
+                ":unconfirmed": {"BOOL": False},
+            },
+            ReturnValues="ALL_NEW",
+            ReturnValuesOnConditionCheckFailure="ALL_OLD",
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            print(f"Error updating DynamoDB: {str(e)}")
+            return False
+        if "Item" in e.response:
+            # Delivered or fallen back already, the outcome still counts
+            record_delivery_outcome(e.response["Item"], False)
+        return True
+    except BotoCoreError as e:
+        print(f"Error updating DynamoDB: {str(e)}")
+        return False
+    item = response["Attributes"]
+    record_delivery_outcome(item, False)
+    if FALLBACK_QUEUE_URL is None:
+        return True
+
+    # Sent through the fallback queue without a delay. The delayed fallback
+    # message finds the fallback sent and is skipped.
+    fallback = deserializer.deserialize(item["fallback_body"])
+    fallback_message_body = {
+        "messageId": message_id,
+        "channel": fallback["channel"],
+        "sender": fallback["sender"],
+        "recipient": fallback["recipient"],
+        "send_body": fallback[fallback["channel"]],
+    }
+    try:
+        sqs.send_message(
+            QueueUrl=FALLBACK_QUEUE_URL,
+            MessageBody=json.dumps(fallback_message_body, default=json_number),
+        )
+        print(f"Fallback of message {message_id} started")
+    except (ClientError, BotoCoreError) as e:
+        # The delayed fallback message still sends it
+        print(f"Error starting fallback of message {message_id}: {str(e)}")
+    return True
+
+
+# Precedence of the updates a message's events call for, lowest first. A
+# delivery settles the message, a hard failure starts its fallback even when
+# the carrier had accepted the message, a soft bounce is only counted.
+UPDATE_PRECEDENCE = {mark_delivered: 0, start_fallback: 1, mark_accepted: 2, record_undelivered: 3}
+
+
+def json_number(value):
+    # DynamoDB numbers are read as Decimal
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
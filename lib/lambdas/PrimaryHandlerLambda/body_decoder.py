@@ -0,0 +1,81 @@
+import json
+import re
+
+# orjson is optional; when it is bundled with the function it parses noticeably faster
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# API Gateway puts every request body through $util.escapeJavaScript before it
+# reaches the queue. These are the escapes it produces: quotes, backslash,
+# forward slash, the short control escapes and \uXXXX for everything else.
+# Surrogate pairs are matched as one escape so emoji come back as one character.
+ESCAPE_PATTERN = re.compile(
+    r'\\(?:u([dD][89abAB][0-9a-fA-F]{2})\\u([dD][c-fC-F][0-9a-fA-F]{2})|u([0-9a-fA-F]{4})|(.))',
+    re.DOTALL
+)
+
+SHORT_ESCAPES = {
+    'b': '\b',
+    't': '\t',
+    'n': '\n',
+    'f': '\f',
+    'r': '\r'
+}
+
+def _unescape(match):
+    high, low, code, char = match.groups()
+    if high:
+        return chr(0x10000 + ((int(high, 16) - 0xD800) << 10) + (int(low, 16) - 0xDC00))
+    if code:
+        return chr(int(code, 16))
+    # \' \" \\ \/ and any other escaped character stand for the character itself
+    return SHORT_ESCAPES.get(char, char)
+
+def unescape_javascript(text):
+    # Bodies without a single backslash need no work at all
+    if '\\' not in text:
+        return text
+    # Apart from \' these are exactly the JSON string escapes, so the C string
+    # decoder can undo them. Every quote in the input is escaped, which means a
+    # \' match can never be the tail of an escaped backslash.
+    try:
+        return json.loads('"' + text.replace("\\'", "'") + '"', strict=False)
+    except ValueError:
+        # Escapes JSON does not know about take the slower regular expression path
+        return ESCAPE_PATTERN.sub(_unescape, text)
+
+def loads(text):
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            # orjson refuses lone surrogates that the standard library accepts
+            pass
+    return json.loads(text)
+
+def unescape_literals(text):
+    # Drops the escapes of characters JSON takes literally, which turns an
+    # escaped JSON body back into JSON: \uXXXX and the short control escapes
+    # only occur inside strings, where the parser reads them the same way.
+    # Escaped backslashes are parked on NUL first, the escaper never leaves a
+    # raw NUL in its output.
+    return (text.replace('\\\\', '\0')
+            .replace('\\"', '"')
+            .replace("\\'", "'")
+            .replace('\\/', '/')
+            .replace('\0', '\\'))
+
+def decode_body(body):
+    # The body is parsed once, without decoding it into a JSON string first.
+    # This is still slower than the unicode_escape decoding it replaced (about
+    # 20 vs 15 us for a 750 character body, see benchmarks/bench_body_decoder.py)
+    # because the parser now has to undo the \uXXXX escapes too; what it buys is
+    # that non-ASCII text and escaped backslashes come through intact.
+    try:
+        return loads(unescape_literals(body))
+    except ValueError:
+        # Whitespace between tokens (a pretty-printed body) arrives as \n, \t or
+        # \r, which JSON only accepts inside strings
+        return loads(unescape_javascript(body))
@@ -0,0 +1,226 @@
+import os
+import threading
+import time
+from collections import Counter
+from botocore.exceptions import BotoCoreError, ClientError
+from aws_clients import dynamodb
+
+# Breaker state lives in the shared state table so every container sees the
+# same state. Without a table name the breaker is off.
+STATE_TABLE_NAME = os.environ.get('STATE_TABLE_NAME')
+
+# Outcomes are counted per channel and sender in fixed windows. Send errors
+# come from this handler, delivery outcomes from the event processor.
+WINDOW_SECONDS = 60
+WINDOW_TTL_SECONDS = 3600
+
+MIN_VOLUME = int(os.environ.get('BREAKER_MIN_VOLUME', '20'))
+MAX_ERROR_RATIO = float(os.environ.get('BREAKER_MAX_ERROR_RATIO', '0.5'))
+MAX_UNDELIVERED_RATIO = float(os.environ.get('BREAKER_MAX_UNDELIVERED_RATIO', '0.5'))
+OPEN_SECONDS = int(os.environ.get('BREAKER_OPEN_SECONDS', '60'))
+PROBE_INTERVAL_SECONDS = int(os.environ.get('BREAKER_PROBE_INTERVAL_SECONDS', '10'))
+
+# How long a container trusts the state it last read
+REFRESH_SECONDS = 10
+
+states = {}
+send_outcomes = Counter()
+lock = threading.Lock()
+
+def breaker_key(channel, sender):
+    return {'pk': {'S': f'breaker#{channel}#{sender}'}}
+
+def window_key(channel, sender, window):
+    return {'pk': {'S': f'breaker#{channel}#{sender}#{window}'}}
+
+def current_window(now):
+    return int(now) // WINDOW_SECONDS * WINDOW_SECONDS
+
+def number(item, name):
+    return int(item[name]['N']) if name in item else 0
+
+def should_trip(window_items, closed_at):
+    # Windows that started before the breaker last closed describe the outage it recovered from
+    windows = [item for item in window_items if number(item, 'window') >= closed_at]
+    sent = sum(number(item, 'sent') for item in windows)
+    send_errors = sum(number(item, 'send_errors') for item in windows)
+    delivered = sum(number(item, 'delivered') for item in windows)
+    undelivered = sum(number(item, 'undelivered') for item in windows)
+
+    attempts = sent + send_errors
+    if attempts >= MIN_VOLUME and send_errors / attempts >= MAX_ERROR_RATIO:
+        return True
+    outcomes = delivered + undelivered
+    return outcomes >= MIN_VOLUME and undelivered / outcomes >= MAX_UNDELIVERED_RATIO
+
+def trip(channel, sender, now):
+    # Only one container opens a closed breaker, the others find it already
+    # open. A recovering breaker is closed or reopened by its probes.
+    try:
+        dynamodb.update_item(
+            TableName=STATE_TABLE_NAME,
+            Key=breaker_key(channel, sender),
+            UpdateExpression='SET #open_until = :open_until',
+            ConditionExpression='attribute_not_exists(#open_until)',
+            ExpressionAttributeNames={'#open_until': 'open_until'},
+            ExpressionAttributeValues={
+                ':open_until': {'N': str(int(now) + OPEN_SECONDS)}
+            }
+        )
+        print(f"Circuit breaker opened for {channel} sender {sender}")
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            print("Error opening circuit breaker:", e)
+    except BotoCoreError as e:
+        print("Error opening circuit breaker:", e)
+
+def load_state(channel, sender, now):
+    window = current_window(now)
+    keys = [
+        breaker_key(channel, sender),
+        window_key(channel, sender, window),
+        window_key(channel, sender, window - WINDOW_SECONDS)
+    ]
+    response = dynamodb.batch_get_item(RequestItems={STATE_TABLE_NAME: {'Keys': keys}})
+    items = {item['pk']['S']: item for item in response['Responses'].get(STATE_TABLE_NAME, [])}
+
+    breaker = items.pop(keys[0]['pk']['S'], {})
+    state = {
+        'checked_at': now,
+        'open_until': number(breaker, 'open_until'),
+        'closed_at': number(breaker, 'closed_at')
+    }
+    if not state['open_until'] and should_trip(items.values(), state['closed_at']):
+        trip(channel, sender, now)
+        state['open_until'] = int(now) + OPEN_SECONDS
+    return state
+
+def get_state(channel, sender, now):
+    key = (channel, sender)
+    state = states.get(key)
+    if state is None or state['checked_at'] + REFRESH_SECONDS <= now:
+        try:
+            state = load_state(channel, sender, now)
+        except (ClientError, BotoCoreError) as e:
+            # Keep the last known state, or treat the channel as healthy
+            print("Error reading circuit breaker state:", e)
+            state = state or {'open_until': 0, 'closed_at': 0}
+            state['checked_at'] = now
+        with lock:
+            states[key] = state
+    return state
+
+def claim_probe(channel, sender, now):
+    # After the open period one send at a time is let through to test the channel
+    try:
+        dynamodb.update_item(
+            TableName=STATE_TABLE_NAME,
+            Key=breaker_key(channel, sender),
+            UpdateExpression='SET #probe_at = :now',
+            ConditionExpression='#open_until <= :now AND (attribute_not_exists(#probe_at) OR #probe_at <= :last_probe)',
+            ExpressionAttributeNames={'#open_until': 'open_until', '#probe_at': 'probe_at'},
+            ExpressionAttributeValues={
+                ':now': {'N': str(int(now))},
+                ':last_probe': {'N': str(int(now) - PROBE_INTERVAL_SECONDS)}
+            }
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            print("Error claiming circuit breaker probe:", e)
+        return False
+    except BotoCoreError as e:
+        print("Error claiming circuit breaker probe:", e)
+        return False
+
+def allow(channel, sender):
+    # Returns 'closed' when the channel can be used, 'probe' when this send
+    # tests a recovering channel and None while the breaker is open
+    if STATE_TABLE_NAME is None:
+        return 'closed'
+    now = time.time()
+    state = get_state(channel, sender, now)
+    if not state['open_until']:
+        return 'closed'
+    if state['open_until'] > now:
+        return None
+    return 'probe' if claim_probe(channel, sender, now) else None
+
+def probe_result(channel, sender, success):
+    now = int(time.time())
+    if success:
+        # The channel answers again, close the breaker for every container
+        update = 'REMOVE #open_until, #probe_at SET #closed_at = :now'
+        names = {'#open_until': 'open_until', '#probe_at': 'probe_at', '#closed_at': 'closed_at'}
+        values = {':now': {'N': str(now)}}
+        state = {'open_until': 0, 'closed_at': now}
+    else:
+        update = 'SET #open_until = :open_until'
+        names = {'#open_until': 'open_until'}
+        values = {':open_until': {'N': str(now + OPEN_SECONDS)}}
+        state = {'open_until': now + OPEN_SECONDS, 'closed_at': 0}
+    try:
+        dynamodb.update_item(
+            TableName=STATE_TABLE_NAME,
+            Key=breaker_key(channel, sender),
+            UpdateExpression=update,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values
+        )
+    except (ClientError, BotoCoreError) as e:
+        print("Error updating circuit breaker:", e)
+        return
+    print(f"Circuit breaker {'closed' if success else 'reopened'} for {channel} sender {sender}")
+    state['checked_at'] = now
+    with lock:
+        states[(channel, sender)] = state
+
+def record_send(channel, sender, success):
+    if STATE_TABLE_NAME is None:
+        return
+    with lock:
+        send_outcomes[(channel, sender, 'sent' if success else 'send_errors')] += 1
+
+def flush():
+    # Adds the invocation's send outcomes to the shared windows, one write per channel and sender
+    if STATE_TABLE_NAME is None:
+        return
+    with lock:
+        outcomes = dict(send_outcomes)
+        send_outcomes.clear()
+
+    now = time.time()
+    window = current_window(now)
+    totals = {}
+    for (channel, sender, outcome), count in outcomes.items():
+        totals.setdefault((channel, sender), {})[outcome] = count
+
+    for (channel, sender), counts in totals.items():
+        names = {'#window': 'window', '#expires_at': 'expires_at'}
+        values = {
+            ':window': {'N': str(window)},
+            ':expires_at': {'N': str(window + WINDOW_TTL_SECONDS)}
+        }
+        additions = []
+        for outcome, count in counts.items():
+            names['#' + outcome] = outcome
+            values[':' + outcome] = {'N': str(count)}
+            additions.append(f'#{outcome} :{outcome}')
+        try:
+            response = dynamodb.update_item(
+                TableName=STATE_TABLE_NAME,
+                Key=window_key(channel, sender, window),
+                UpdateExpression='ADD ' + ', '.join(additions) + ' SET #window = :window, #expires_at = :expires_at',
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+                ReturnValues='ALL_NEW'
+            )
+        except (ClientError, BotoCoreError) as e:
+            print("Error recording send outcomes:", e)
+            continue
+
+        state = states.get((channel, sender), {})
+        if not state.get('open_until') and should_trip([response['Attributes']], state.get('closed_at', 0)):
+            trip(channel, sender, now)
+            with lock:
+                states[(channel, sender)] = {'checked_at': now, 'open_until': int(now) + OPEN_SECONDS, 'closed_at': 0}
@@ -0,0 +1,83 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+from aws_clients import get_client
+
+# Template metadata is kept per container so a template is only fetched once per TTL
+TEMPLATE_CACHE_TTL_SECONDS = int(os.environ.get('TEMPLATE_CACHE_TTL_SECONDS', '300'))
+TEMPLATE_CACHE_SIZE = int(os.environ.get('TEMPLATE_CACHE_SIZE', '100'))
+
+# Handlebars tags: {{name}}, {{{name}}}, {{#if name}}, {{/if}}, {{else}}
+TAG_PATTERN = re.compile(r'{{{?\s*([#/^]?)\s*([^}]*?)\s*}?}}')
+NAME_PATTERN = re.compile(r'[A-Za-z_][\w-]*')
+
+# Cached value of a template that does not exist
+MISSING = object()
+
+templates = OrderedDict()
+templates_lock = threading.Lock()
+
+def required_variables(*parts):
+    # Only variables referenced outside of any block are required. Inside
+    # {{#if}} or {{#each}} they are optional or belong to the iterated items.
+    variables = set()
+    depth = 0
+    for part in parts:
+        for prefix, expression in TAG_PATTERN.findall(part or ''):
+            if prefix in ('#', '^'):
+                depth += 1
+            elif prefix == '/':
+                depth = max(depth - 1, 0)
+            elif depth == 0:
+                match = NAME_PATTERN.match(expression)
+                if match and match.group() not in ('else', 'this'):
+                    variables.add(match.group())
+    return frozenset(variables)
+
+def load_template(template_name):
+    try:
+        response = get_client('sesv2').get_email_template(TemplateName=template_name)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NotFoundException':
+            return MISSING
+        raise
+    content = response['TemplateContent']
+    return required_variables(content.get('Subject'), content.get('Text'), content.get('Html'))
+
+def get_required_variables(template_name):
+    now = time.monotonic()
+    with templates_lock:
+        cached = templates.get(template_name)
+        if cached is not None and cached[0] > now:
+            templates.move_to_end(template_name)
+            return cached[1]
+
+    # Fetched outside the lock, concurrent misses for one template at worst fetch it twice
+    variables = load_template(template_name)
+
+    with templates_lock:
+        templates[template_name] = (now + TEMPLATE_CACHE_TTL_SECONDS, variables)
+        templates.move_to_end(template_name)
+        while len(templates) > TEMPLATE_CACHE_SIZE:
+            templates.popitem(last=False)
+    return variables
+
+def template_data_error(template_name, template_data):
+    # Returns why the template cannot be rendered with this data, or None when it can
+    if template_data is not None and not isinstance(template_data, dict):
+        return "template_data must be an object"
+    try:
+        variables = get_required_variables(template_name)
+    except Exception as e:
+        # Without the template metadata the send goes ahead unchecked
+        print(f"Could not load email template {template_name}:", e)
+        return None
+    if variables is MISSING:
+        return f"Email template {template_name} does not exist"
+    missing = variables.difference(template_data or {})
+    if missing:
+        return f"Missing template_data for {', '.join(sorted(missing))}"
+    return None
@@ -1,84 +1,343 @@
-import json
+import importlib
 import os
-import boto3
+import threading
+import uuid
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime
-from send_email import send_email
-from send_sms import send_sms
-from send_whatsapp import send_whatsapp
+from aws_clients import MAX_CONCURRENCY, CHANNEL_CONCURRENCY, init_client
+from body_decoder import decode_body
+from email_templates import template_data_error
+from fallback_queue import schedule_fallbacks
+from message_store import store_messages
+from rate_limiter import acquire
+import circuit_breaker
+import retry
 
-sqs = boto3.client('sqs')
-dynamodb = boto3.resource('dynamodb')
+# Created once per container and reused by every invocation. Broadcast fan-out
+# gets its own pool so record workers never wait on tasks queued behind themselves.
+executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+broadcast_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+channel_semaphores = {
+    channel: threading.BoundedSemaphore(limit) for channel, limit in CHANNEL_CONCURRENCY.items()
+}
+
+# Every invocation enqueues fallbacks, the queue client is built up front
+init_client('sqs')
+
+# Channel drivers are imported the first time a channel is used and cached
+# for the life of the container
+CHANNEL_DRIVERS = {
+    'email': ('send_email', 'send_email'),
+    'email_bulk': ('send_email', 'send_bulk_email'),
+    'sms': ('send_sms', 'send_sms'),
+    'whatsapp': ('send_whatsapp', 'send_whatsapp')
+}
+drivers = {}
+
+# fallback_seconds is optional in the request
+DEFAULT_FALLBACK_SECONDS = int(os.environ.get('DEFAULT_FALLBACK_SECONDS', '60'))
+CHANNELS = ('email', 'sms', 'whatsapp')
+
+def get_driver(channel):
+    driver = drivers.get(channel)
+    if driver is None:
+        module_name, function_name = CHANNEL_DRIVERS[channel]
+        driver = drivers[channel] = getattr(importlib.import_module(module_name), function_name)
+    return driver
 
 def lambda_handler(event, context):
     print(event)
-    
+    retry.start_invocation(context)
+
+    failed_record_ids = []
+    futures = {}
+    template_emails = defaultdict(list)
+
     for record in event['Records']:
-        body_str = record['body'].encode().decode('unicode_escape')
-        body = json.loads(body_str)
-        
-        if body['use_case'] == "fallback":
-            # Handle the primary channel
-            pc = body['pc']
-            channel_data = pc[pc['channel']]
-            message_id = send_message(pc['channel'], pc['sender'], pc['recipient'], channel_data)
-            
-            # Generate timestamp for when the primary channel message was sent
-            pc_message_sent_timestamp = datetime.utcnow().isoformat()
-
-            # Store the message with additional attributes
-            store_message(
-                message_id=message_id, 
-                recipient=pc['recipient'], 
-                sender=pc['sender'], 
-                send_body=channel_data, 
-                channel=pc['channel'], 
-                use_case=body['use_case'],
-                fallback_channel=body['fc']['channel'],
-                pc_message_sent_timestamp=pc_message_sent_timestamp,
-                fallback_body=body['fc']
-            )
-            
-            # Prepare and send the fallback information to the fallback queue with visibility timeout
-            fc = body['fc']
-            fallback_message_body = {
-                'messageId': message_id,
-                'channel': fc['channel'],
-                'sender': fc['sender'],
-                'recipient': fc['recipient'],
-                'send_body': fc[fc['channel']]
-            }
-            
-            if 'configuration_set' in fc['channel']:
-                fallback_message_body['configuration_set'] = fc['channel']['configuration_set']
-
-            sqs.send_message(
-                QueueUrl=os.environ['FALLBACK_QUEUE_URL'],
-                DelaySeconds=int(body['fallback_seconds']),
-                MessageBody=json.dumps(fallback_message_body)
-            )
-        
-        elif body['use_case'] == "broadcast":
-            # Send to both primary and fallback channels without logging to DynamoDB
-            pc = body['pc']
-            fc = body['fc']
-            
-            # Send message to primary channel
-            send_message(pc['channel'], pc['sender'], pc['recipient'], pc[pc['channel']])
-            
-            # Send message to fallback channel
-            send_message(fc['channel'], fc['sender'], fc['recipient'], fc[fc['channel']])
+        try:
+            # Reverse the API Gateway escapeJavaScript mapping and parse the body
+            body = decode_body(record['body'])
+            validate_body(body)
+            key = template_email_key(body)
+        except Exception as e:
+            print(f"Invalid record {record['messageId']}:", e)
+            failed_record_ids.append(record['messageId'])
+            continue
+
+        if key is None:
+            # Records are independent of each other, a failing record does not affect its neighbours
+            futures[record['messageId']] = executor.submit(process_record, record, body)
+        else:
+            template_emails[key].append((record, body))
+
+    # Template emails that share a sender, template and configuration set go out
+    # through SendBulkEmail, each record still gets its own future
+    for key, group in template_emails.items():
+        if len(group) == 1:
+            record, body = group[0]
+            futures[record['messageId']] = executor.submit(process_record, record, body)
+            continue
+        group = [(record, body, Future()) for record, body in group]
+        for record, _, future in group:
+            futures[record['messageId']] = future
+        executor.submit(process_template_emails, key, group)
+
+    sent = []
+    for record_id, future in futures.items():
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"Error processing record {record_id}:", e)
+            failed_record_ids.append(record_id)
+            continue
+        if result:
+            sent.append(result)
+
+    # Persist the whole batch before any of its fallbacks can fire
+    failed_message_ids = set(store_messages([result['item'] for result in sent]))
+    for result in sent:
+        if result['item']['messageId'] in failed_message_ids:
+            failed_record_ids.append(result['record_id'])
+    sent = [result for result in sent if result['item']['messageId'] not in failed_message_ids]
+
+    # Enqueue the fallbacks of the whole batch with as few SQS calls as possible,
+    # messages whose fallback already went out have none
+    failed_record_ids.extend(schedule_fallbacks([result['fallback'] for result in sent if result['fallback']]))
+    retry.report()
+    try:
+        circuit_breaker.flush()
+    except Exception as e:
+        # The records are sent and stored, breaker bookkeeping must not send them again
+        print("Error flushing circuit breaker outcomes:", e)
+
+    # Only the failed records are returned to the queue for another attempt
+    return {
+        'batchItemFailures': [{'itemIdentifier': record_id} for record_id in failed_record_ids]
+    }
+
+def validate_body(body):
+    # A fallback record is checked before its primary message is sent. Failing
+    # it afterwards would send the primary message again on every redelivery.
+    if body.get('use_case') != "fallback":
+        return
+    for name in ('pc', 'fc'):
+        c = body.get(name)
+        if not isinstance(c, dict) or c.get('channel') not in CHANNELS:
+            raise ValueError(f"{name} needs a channel out of {', '.join(CHANNELS)}")
+        for field in ('sender', 'recipient'):
+            if not c.get(field):
+                raise ValueError(f"{name} needs a {field}")
+        if not isinstance(c.get(c['channel']), dict):
+            raise ValueError(f"{name} needs the {c['channel']} content")
+    fallback_seconds = int(body.get('fallback_seconds', DEFAULT_FALLBACK_SECONDS))
+    if fallback_seconds < 0:
+        raise ValueError("fallback_seconds can not be negative")
+    body['fallback_seconds'] = fallback_seconds
+
+def template_email_key(body):
+    # Fallback records whose primary channel is a template email can share a bulk send
+    if body.get('use_case') != "fallback" or body['pc']['channel'] != "email":
+        return None
+    content = body['pc']['email']
+    if "template" not in content:
+        return None
+    return (body['pc']['sender'], content['template'], content.get('configuration_set'))
+
+def process_template_emails(key, group):
+    sender, template_name, configuration_set = key
+    try:
+        # Records the template cannot be rendered for go straight to their fallback
+        accepted = []
+        for record, body, future in group:
+            rejection = primary_rejection(body)
+            if rejection is None:
+                accepted.append((record, body, future))
+            else:
+                future.set_result(immediate_fallback(record, body, rejection, 'primary_rejected'))
+        group = accepted
+        if not group:
+            return
+
+        breaker = circuit_breaker.allow('email', sender)
+        if breaker is None:
+            for record, body, future in group:
+                future.set_result(immediate_fallback(record, body, "circuit breaker open", 'circuit_open'))
+            return
+
+        # The group is cut to what the send rate allows, the rest is received again
+        allowed = acquire('email', sender, len(group))
+        if not allowed:
+            raise Exception("Email send rate limit reached")
+        for _, _, future in group[allowed:]:
+            future.set_exception(Exception("Email send rate limit reached"))
+        group = group[:allowed]
+        destinations = [(body['pc']['recipient'], body['pc']['email'].get('template_data')) for _, body, _ in group]
+        with channel_semaphores['email']:
+            message_ids = get_driver('email_bulk')(sender, template_name, configuration_set, destinations)
+        for message_id in message_ids:
+            circuit_breaker.record_send('email', sender, message_id is not None)
+        if breaker == 'probe':
+            circuit_breaker.probe_result('email', sender, any(message_ids))
+    except Exception as e:
+        for _, _, future in group:
+            if not future.done():
+                future.set_exception(e)
+        return
+
+    for (record, body, future), message_id in zip(group, message_ids):
+        try:
+            future.set_result(fallback_result(record, body, message_id))
+        except Exception as e:
+            future.set_exception(e)
+
+def process_record(record, body):
+    if body['use_case'] == "fallback":
+        # Handle the primary channel
+        pc = body['pc']
+        rejection = primary_rejection(body)
+        if rejection is not None:
+            return immediate_fallback(record, body, rejection, 'primary_rejected')
+
+        # While the primary channel is failing the message goes out on the fallback channel right away
+        breaker = circuit_breaker.allow(pc['channel'], pc['sender'])
+        if breaker is None:
+            return immediate_fallback(record, body, "circuit breaker open", 'circuit_open')
+
+        message_id = send_message(pc['channel'], pc['sender'], pc['recipient'], pc[pc['channel']])
+        if breaker == 'probe':
+            circuit_breaker.probe_result(pc['channel'], pc['sender'], message_id is not None)
+        return fallback_result(record, body, message_id)
+
+    elif body['use_case'] == "broadcast":
+        # Send to every channel at the same time without logging to DynamoDB,
+        # defaulting to the primary and fallback channels
+        channels = body.get('channels') or [body['pc'], body['fc']]
+        results = broadcast_message(channels)
+        print("Broadcast results:", results)
+
+        # Only retry when nothing went out, a retry would duplicate the successful sends
+        if not any(result['message_id'] for result in results):
+            raise Exception("Failed to send message on every broadcast channel")
+
+def primary_rejection(body):
+    # Template emails are checked against the template before the send, SES
+    # would only report a rendering failure after the whole fallback window
+    pc = body['pc']
+    content = pc[pc['channel']]
+    if pc['channel'] != "email" or "template" not in content:
+        return None
+    return template_data_error(content['template'], content.get('template_data'))
+
+def immediate_fallback(record, body, reason, status):
+    # Nothing was sent, the message is tracked under its own id and falls back right away
+    print(f"Primary message of record {record['messageId']} not sent:", reason)
+    return fallback_result(record, body, str(uuid.uuid4()), status=status, delay_seconds=0)
+
+def primary_failed_result(record, body):
+    # The primary provider refused the message, the fallback is sent in this
+    # invocation instead of after fallback_seconds
+    pc = body['pc']
+    fc = body['fc']
+    fallback_message_id = send_message(fc['channel'], fc['sender'], fc['recipient'], fc[fc['channel']], message_type='fallback')
+    if fallback_message_id is None:
+        raise Exception(f"Failed to send message on primary channel {pc['channel']} and fallback channel {fc['channel']}")
+    print(f"Primary message of record {record['messageId']} failed, sent on fallback channel {fc['channel']}:", fallback_message_id)
+
+    item = primary_message_item(body, str(uuid.uuid4()), 'primary_failed')
+    item['fc_message_sent_timestamp'] = datetime.utcnow().isoformat()
+    return {
+        'record_id': record['messageId'],
+        'item': item,
+        'fallback': None
+    }
+
+def fallback_result(record, body, message_id, status='sent', delay_seconds=None):
+    if message_id is None:
+        return primary_failed_result(record, body)
+
+    # Build the message item with additional attributes, it is stored with the rest of the batch
+    item = primary_message_item(body, message_id, status)
+
+    # Prepare the fallback information, it is enqueued with the rest of the batch
+    fc = body['fc']
+    fallback_message_body = {
+        'messageId': message_id,
+        'channel': fc['channel'],
+        'sender': fc['sender'],
+        'recipient': fc['recipient'],
+        'send_body': fc[fc['channel']]
+    }
+    
+    if 'configuration_set' in fc['channel']:
+        fallback_message_body['configuration_set'] = fc['channel']['configuration_set']
 
     return {
-        'statusCode': 200,
-        'body': json.dumps({'message': 'Processed successfully'})
+        'record_id': record['messageId'],
+        'item': item,
+        'fallback': {
+            'record_id': record['messageId'],
+            'body': fallback_message_body,
+            'delay_seconds': body['fallback_seconds'] if delay_seconds is None else delay_seconds
+        }
     }
 
-def send_message(channel, sender, recipient, content):
+def primary_message_item(body, message_id, status):
+    pc = body['pc']
+    channel_data = pc[pc['channel']]
+
+    # Generate timestamp for when the primary channel message was sent
+    pc_message_sent_timestamp = datetime.utcnow().isoformat()
+
+    return build_message_item(
+        message_id=message_id, 
+        recipient=pc['recipient'], 
+        sender=pc['sender'], 
+        send_body=channel_data, 
+        channel=pc['channel'], 
+        use_case=body['use_case'],
+        status=status,
+        fallback_channel=body['fc']['channel'],
+        pc_message_sent_timestamp=pc_message_sent_timestamp,
+        fallback_body=body['fc']
+    )
+
+def broadcast_message(channels):
+    futures = [broadcast_executor.submit(broadcast_send, c) for c in channels]
+    return [
+        {'channel': c['channel'], 'recipient': c['recipient'], 'message_id': future.result()}
+        for c, future in zip(channels, futures)
+    ]
+
+def broadcast_send(c):
+    try:
+        return send_message(c['channel'], c['sender'], c['recipient'], c[c['channel']])
+    except Exception as e:
+        print(f"Error broadcasting on channel {c['channel']}:", e)
+        return None
+
+def send_message(channel, sender, recipient, content, message_type='primary'):
+    # Wait for the fleet-wide send rate before taking a slot. A message held
+    # back by the rate is retried later, it did not fail.
+    if not acquire(channel, sender):
+        raise Exception(f"Send rate limit reached on channel {channel}")
+    # Hold the channel's slot only for the duration of the provider call
+    with channel_semaphores.get(channel, nullcontext()):
+        message_id = dispatch_message(channel, sender, recipient, content, message_type)
+    # The breaker watches the primary channels only
+    if message_type == 'primary':
+        circuit_breaker.record_send(channel, sender, message_id is not None)
+    return message_id
+
+def dispatch_message(channel, sender, recipient, content, message_type):
     if channel == "email":
         if "template" in content:
             send_body = {
                 "template": content['template']
             }
+            if 'template_data' in content:
+                send_body['template_data'] = content['template_data']
             if 'configuration_set' in content:
                 send_body['configuration_set'] = content['configuration_set']
         else:
@@ -89,31 +348,30 @@ def send_message(channel, sender, recipient, content):
             } 
             if 'configuration_set' in content:
                 send_body['configuration_set'] = content['configuration_set']                   
-        return send_email(sender, recipient, send_body)
+        return get_driver('email')(sender, recipient, send_body, message_type)
     elif channel == "sms":
         send_body = {
             "message": content['message'],
             "message_type": content['message_type'],
             "configuration_set": content['configuration_set']
         } 
-        return send_sms(sender, recipient, send_body)
+        return get_driver('sms')(sender, recipient, send_body, message_type)
     elif channel == "whatsapp":
         send_body = {
             "message": content['message']
         }
-        return send_whatsapp(sender, recipient, send_body)
+        return get_driver('whatsapp')(sender, recipient, send_body)
 
-def store_message(message_id, recipient, sender, send_body, channel, use_case, fallback_channel, pc_message_sent_timestamp, fallback_body):
-    table = dynamodb.Table(os.environ['DYNAMODB_TABLE_NAME'])
-    table.put_item(Item={
+def build_message_item(message_id, recipient, sender, send_body, channel, use_case, status, fallback_channel, pc_message_sent_timestamp, fallback_body):
+    return {
         'messageId': message_id,
         'recipient': recipient,
         'sender': sender,
         'message': str(send_body),
         'primary_channel': channel,
         'use_case': use_case,
-        'status': 'sent',
+        'status': status,
         'fallback_channel': fallback_channel,
         'pc_message_sent_timestamp': pc_message_sent_timestamp,
         'fallback_body': fallback_body
-    })
\ No newline at end of file
+    }
\ No newline at end of file
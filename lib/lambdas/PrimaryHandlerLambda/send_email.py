@@ -1,7 +1,18 @@
-import boto3
-sesv2_client = boto3.client('sesv2')
+import json
+from aws_clients import get_client
+from retry import call
 
-def send_email(sender, recipient, send_body):
+# SendBulkEmail accepts at most 50 destinations per call
+MAX_BULK_DESTINATIONS = 50
+
+def encode_template_data(template_data):
+    # Requests carry the data as a JSON object, SES takes it as a JSON string
+    if isinstance(template_data, str):
+        return template_data
+    return json.dumps(template_data or {})
+
+def send_email(sender, recipient, send_body, message_type='primary'):
+    sesv2_client = get_client('sesv2')
     try:
         if "template" in send_body:
             template_name = send_body['template']
@@ -13,13 +24,13 @@ def send_email(sender, recipient, send_body):
                 'Content': {
                     'Template': {
                         'TemplateName': template_name,
-                        'TemplateData': '{}'
+                        'TemplateData': encode_template_data(send_body.get('template_data'))
                     }
                 },
                  'EmailTags':[
                     {
                         'Name': 'message_type',
-                        'Value': 'primary'
+                        'Value': message_type
                     }
                 ]
             }
@@ -28,7 +39,7 @@ def send_email(sender, recipient, send_body):
             if 'configuration_set' in send_body:
                 email_params['ConfigurationSetName'] = send_body['configuration_set']
 
-            response = sesv2_client.send_email(**email_params)
+            response = call(sesv2_client.send_email, **email_params)
             return response['MessageId']
 
         else:
@@ -62,7 +73,7 @@ def send_email(sender, recipient, send_body):
                  'EmailTags':[
                     {
                         'Name': 'message_type',
-                        'Value': 'primary'
+                        'Value': message_type
                     }
                 ]
             }
@@ -71,8 +82,65 @@ def send_email(sender, recipient, send_body):
             if 'configuration_set' in send_body:
                 email_params['ConfigurationSetName'] = send_body['configuration_set']
 
-            response = sesv2_client.send_email(**email_params)
+            response = call(sesv2_client.send_email, **email_params)
             return response['MessageId']
     except Exception as e:
         print("Error sending email:", e)
-        return None
\ No newline at end of file
+        return None
+
+def send_bulk_email(sender, template_name, configuration_set, destinations):
+    # destinations holds (recipient, template_data) pairs. Returns the MessageId
+    # of every destination in the same order, None where the send failed.
+    sesv2_client = get_client('sesv2')
+    message_ids = []
+
+    for start in range(0, len(destinations), MAX_BULK_DESTINATIONS):
+        chunk = destinations[start:start + MAX_BULK_DESTINATIONS]
+        email_params = {
+            'FromEmailAddress': sender,
+            'DefaultContent': {
+                'Template': {
+                    'TemplateName': template_name,
+                    'TemplateData': '{}'
+                }
+            },
+            'BulkEmailEntries': [
+                {
+                    'Destination': {
+                        'ToAddresses': [recipient],
+                    },
+                    'ReplacementEmailContent': {
+                        'ReplacementTemplate': {
+                            'ReplacementTemplateData': encode_template_data(template_data)
+                        }
+                    }
+                }
+                for recipient, template_data in chunk
+            ],
+            'DefaultEmailTags': [
+                {
+                    'Name': 'message_type',
+                    'Value': 'primary'
+                }
+            ]
+        }
+
+        if configuration_set is not None:
+            email_params['ConfigurationSetName'] = configuration_set
+
+        try:
+            response = call(sesv2_client.send_bulk_email, **email_params)
+        except Exception as e:
+            print("Error sending bulk email:", e)
+            message_ids.extend([None] * len(chunk))
+            continue
+
+        # Results come back in the order of the entries
+        for (recipient, _), result in zip(chunk, response['BulkEmailEntryResults']):
+            if result['Status'] == 'SUCCESS':
+                message_ids.append(result['MessageId'])
+            else:
+                print(f"Error sending email to {recipient}:", result['Status'], result.get('Error'))
+                message_ids.append(None)
+
+    return message_ids
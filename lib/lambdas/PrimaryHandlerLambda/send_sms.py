@@ -1,17 +1,19 @@
-import boto3
-client = boto3.client('pinpoint-sms-voice-v2')
+from aws_clients import get_client
+from retry import call
 
-def send_sms(sender, recipient, send_body):
+def send_sms(sender, recipient, send_body, message_type='primary'):
+    client = get_client('pinpoint-sms-voice-v2')
 
     try:
-        response = client.send_text_message(
+        response = call(
+            client.send_text_message,
             DestinationPhoneNumber=recipient,
             OriginationIdentity=sender,
             MessageBody=send_body['message'],
             MessageType=send_body['message_type'],
             ConfigurationSetName=send_body['configuration_set'],
             Context={
-                'message_type': 'primary'
+                'message_type': message_type
             }
         )
         return response['MessageId']
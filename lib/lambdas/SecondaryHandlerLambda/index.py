@@ -1,70 +1,211 @@
+import importlib
 import json
-import boto3
-import os
+import math
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime
-from send_email import send_email
-from send_sms import send_sms
-from send_whatsapp import send_whatsapp
+from aws_clients import MAX_CONCURRENCY, CHANNEL_CONCURRENCY
+from fallback_queue import schedule_fallbacks
+from message_store import claim_fallback, get_messages, release_fallback
+from rate_limiter import acquire
+import retry
 
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(os.environ['DYNAMODB_TABLE_NAME'])
+# Created once per container and reused by every invocation
+executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+channel_semaphores = {
+    channel: threading.BoundedSemaphore(limit) for channel, limit in CHANNEL_CONCURRENCY.items()
+}
+
+# Channel drivers are imported the first time a channel is used and cached
+# for the life of the container
+CHANNEL_DRIVERS = {
+    'email': ('send_email', 'send_email'),
+    'email_bulk': ('send_email', 'send_bulk_email'),
+    'sms': ('send_sms', 'send_sms'),
+    'whatsapp': ('send_whatsapp', 'send_whatsapp')
+}
+drivers = {}
+
+# Messages in these states need no fallback. A hard delivery failure sends the
+# fallback early, the delayed fallback message then finds it sent_fallback.
+FALLBACK_DONE_STATUSES = ('delivered', 'sent_fallback')
+
+def get_driver(channel):
+    driver = drivers.get(channel)
+    if driver is None:
+        module_name, function_name = CHANNEL_DRIVERS[channel]
+        driver = drivers[channel] = getattr(importlib.import_module(module_name), function_name)
+    return driver
 
 def lambda_handler(event, context):
+    retry.start_invocation(context)
+    failed_record_ids = []
+
+    bodies = {}
+    message_ids = []
     for record in event['Records']:
-        # Parse the SQS message body
-        body = json.loads(record['body'])
-        
-        message_id = body['messageId']
-        channel = body['channel']
-        sender = body['sender']
-        recipient = body['recipient']
-        send_body = body['send_body']
-        
-        # Check the delivery status in DynamoDB
-        response = table.get_item(Key={'messageId': message_id})
-        
-        if 'Item' in response:
-            item = response['Item']
-            status = item.get('status')
-            
-            if status != 'delivered':
-                # If not delivered, send the message using the fallback channel
-                send_secondary_message(channel, sender, recipient, send_body)
-                
-                # Generate timestamp for when the fallback channel message was sent
-                fc_message_sent_timestamp = datetime.utcnow().isoformat()
-                
-                # Update the status and timestamp in DynamoDB
-                table.update_item(
-                    Key={'messageId': message_id},
-                    UpdateExpression='SET #status = :status, #fc_timestamp = :fc_timestamp',
-                    ExpressionAttributeNames={
-                        '#status': 'status',
-                        '#fc_timestamp': 'fc_message_sent_timestamp'
-                    },
-                    ExpressionAttributeValues={
-                        ':status': 'sent_fallback',
-                        ':fc_timestamp': fc_message_sent_timestamp
-                    }
-                )
-                
+        try:
+            body = json.loads(record['body'])
+            message_ids.append(body['messageId'])
+            bodies[record['messageId']] = body
+        except Exception as e:
+            print(f"Error decoding record {record['messageId']}:", e)
+            failed_record_ids.append(record['messageId'])
+
+    # The status of the whole batch is read at once, only the messages that
+    # still need their fallback are claimed and sent
+    statuses = get_messages(message_ids)
+
+    futures = {}
+    template_emails = defaultdict(list)
+    waiting = []
+    for record_id, body in bodies.items():
+        try:
+            message_id = body['messageId']
+            if message_id not in statuses or statuses[message_id] in FALLBACK_DONE_STATUSES:
+                continue
+            remaining = body.get('fallback_at', 0) - time.time()
+            if remaining > 0:
+                # Due later than SQS can delay a message, it goes back to the queue
+                waiting.append({
+                    'record_id': record_id,
+                    'body': body,
+                    'delay_seconds': math.ceil(remaining)
+                })
+                continue
+            key = template_email_key(body)
+        except Exception as e:
+            print(f"Error processing record {record_id}:", e)
+            failed_record_ids.append(record_id)
+            continue
+
+        if key is None:
+            # Records are independent of each other, a failing record does not affect its neighbours
+            futures[record_id] = executor.submit(process_record, body)
+        else:
+            template_emails[key].append((record_id, body))
+
+    # Template emails that share a sender, template and configuration set go out through SendBulkEmail
+    group_futures = [executor.submit(send_template_emails, key, group) for key, group in template_emails.items()]
+
+    for record_id, future in futures.items():
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Error processing record {record_id}:", e)
+            failed_record_ids.append(record_id)
+    for future in group_futures:
+        failed_record_ids.extend(future.result())
+    failed_record_ids.extend(schedule_fallbacks(waiting))
+    retry.report()
+
+    # Only the failed records are returned to the queue for another attempt
     return {
-        'statusCode': 200,
-        'body': json.dumps('Processed successfully')
+        'batchItemFailures': [{'itemIdentifier': record_id} for record_id in failed_record_ids]
     }
 
+def template_email_key(body):
+    send_body = body['send_body']
+    if body['channel'] != "email" or "template" not in send_body:
+        return None
+    return (body['sender'], send_body['template'], send_body.get('configuration_set'))
+
+def send_template_emails(key, group):
+    # Returns the SQS messageIds of the records whose fallback could not be completed
+    sender, template_name, configuration_set = key
+    failed_record_ids = []
+
+    # Only the records whose fallback this invocation claims are sent. A claim
+    # holds the message's previous status and the fallback's timestamp.
+    claimed = []
+    for record_id, body in group:
+        fc_message_sent_timestamp = datetime.utcnow().isoformat()
+        try:
+            status = claim_fallback(body['messageId'], fc_message_sent_timestamp)
+        except Exception as e:
+            print(f"Error processing record {record_id}:", e)
+            failed_record_ids.append(record_id)
+            continue
+        if status is not None:
+            claimed.append((record_id, body, (status, fc_message_sent_timestamp)))
+    if not claimed:
+        return failed_record_ids
+
+    try:
+        if len(claimed) == 1:
+            _, body, _ = claimed[0]
+            message_ids = [send_secondary_message(body['channel'], sender, body['recipient'], body['send_body'])]
+        else:
+            # The group is cut to what the send rate allows, the rest is received again
+            allowed = acquire('email', sender, len(claimed))
+            if not allowed:
+                raise Exception("Email send rate limit reached")
+            for record_id, body, claim in claimed[allowed:]:
+                release_fallback(body['messageId'], *claim)
+                failed_record_ids.append(record_id)
+            claimed = claimed[:allowed]
+            destinations = [(body['recipient'], body['send_body'].get('template_data')) for _, body, _ in claimed]
+            with channel_semaphores['email']:
+                message_ids = get_driver('email_bulk')(sender, template_name, configuration_set, destinations)
+    except Exception as e:
+        print("Error sending template emails:", e)
+        for _, body, claim in claimed:
+            release_fallback(body['messageId'], *claim)
+        return failed_record_ids + [record_id for record_id, _, _ in claimed]
+
+    for (record_id, body, claim), fallback_message_id in zip(claimed, message_ids):
+        if fallback_message_id is None:
+            release_fallback(body['messageId'], *claim)
+            print(f"Error processing record {record_id}: Failed to send message on fallback channel {body['channel']}")
+            failed_record_ids.append(record_id)
+    return failed_record_ids
+
+def process_record(body):
+    message_id = body['messageId']
+    channel = body['channel']
+    sender = body['sender']
+    recipient = body['recipient']
+    send_body = body['send_body']
+    
+    # Check the delivery status and mark the fallback sent in one conditional
+    # write. A delivered message, or one whose fallback is already sent or being
+    # sent by another invocation, is skipped.
+    fc_message_sent_timestamp = datetime.utcnow().isoformat()
+    status = claim_fallback(message_id, fc_message_sent_timestamp)
+    
+    if status is not None:
+        # If not delivered, send the message using the fallback channel
+        fallback_message_id = send_secondary_message(channel, sender, recipient, send_body)
+        if fallback_message_id is None:
+            release_fallback(message_id, status, fc_message_sent_timestamp)
+            raise Exception(f"Failed to send message on fallback channel {channel}")
+
 def send_secondary_message(channel, sender, recipient, send_body):
+    # Wait for the fleet-wide send rate of the channel and sender
+    if not acquire(channel, sender):
+        return None
+    # Hold the channel's slot only for the duration of the provider call
+    with channel_semaphores.get(channel, nullcontext()):
+        return dispatch_message(channel, sender, recipient, send_body)
+
+def dispatch_message(channel, sender, recipient, send_body):
     if channel == "email":
         if "template" in send_body:
             
             email_message_body = {
                 "template": send_body['template']
             }
+
+            if 'template_data' in send_body:
+                email_message_body['template_data'] = send_body['template_data']
             
             if 'configuration_set' in send_body:
                 email_message_body['configuration_set'] = send_body['configuration_set']
 
-            send_email(sender, recipient, email_message_body)
+            return get_driver('email')(sender, recipient, email_message_body)
         else:
             email_message_body = {
                 "subject": send_body.get('subject'),
@@ -75,13 +216,13 @@ def send_secondary_message(channel, sender, recipient, send_body):
             if 'configuration_set' in send_body:
                 email_message_body['configuration_set'] = send_body['configuration_set']
 
-            send_email(sender, recipient, email_message_body)
+            return get_driver('email')(sender, recipient, email_message_body)
 
     elif channel == "sms":
-        send_sms(sender, recipient, {
+        return get_driver('sms')(sender, recipient, {
             "message": send_body['message'],
             "message_type": send_body['message_type'],
             "configuration_set": send_body['configuration_set']
         })
     elif channel == "whatsapp":
-        send_whatsapp(sender, recipient, send_body)
\ No newline at end of file
+        return get_driver('whatsapp')(sender, recipient, send_body)
\ No newline at end of file
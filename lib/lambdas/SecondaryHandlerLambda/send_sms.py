@@ -1,10 +1,12 @@
-import boto3
-client = boto3.client('pinpoint-sms-voice-v2')
+from aws_clients import get_client
+from retry import call
 
 def send_sms(sender, recipient, send_body):
+    client = get_client('pinpoint-sms-voice-v2')
 
     try:
-        response = client.send_text_message(
+        response = call(
+            client.send_text_message,
             DestinationPhoneNumber=recipient,
             OriginationIdentity=sender,
             MessageBody=send_body['message'],
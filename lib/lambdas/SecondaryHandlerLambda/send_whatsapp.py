@@ -1,9 +1,9 @@
-import boto3
 import json
-
-client = boto3.client("socialmessaging")
+from aws_clients import get_client
+from retry import call
 
 def send_whatsapp(origination_phone_number_id, recipient, send_body):
+    client = get_client('socialmessaging')
     try:
 
         # Construct the message following Meta API's format
@@ -19,7 +19,8 @@ def send_whatsapp(origination_phone_number_id, recipient, send_body):
         # Convert the message to a JSON string and then to bytes (no Base64 encoding needed)
         message_json = json.dumps(whatsapp_message).encode('utf-8')
 
-        response = client.send_whatsapp_message(
+        response = call(
+            client.send_whatsapp_message,
             originationPhoneNumberId=origination_phone_number_id,
             message=message_json,
             metaApiVersion="v20.0",
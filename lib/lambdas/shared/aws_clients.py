@@ -0,0 +1,82 @@
+import os
+import threading
+import botocore.session
+from botocore.config import Config
+
+# Upper bound on records of a batch that are processed at the same time
+MAX_CONCURRENCY = int(os.environ.get('MAX_CONCURRENCY', '10'))
+
+# Per-channel caps on in-flight provider calls, so one channel cannot take every worker
+CHANNEL_CONCURRENCY = {
+    'email': int(os.environ.get('EMAIL_CONCURRENCY', '10')),
+    'sms': int(os.environ.get('SMS_CONCURRENCY', '5')),
+    'whatsapp': int(os.environ.get('WHATSAPP_CONCURRENCY', '5'))
+}
+
+# A channel client never has more calls in flight than its channel's cap,
+# every other client is used by at most one call per worker
+POOL_SIZES = {
+    'sesv2': CHANNEL_CONCURRENCY['email'],
+    'pinpoint-sms-voice-v2': CHANNEL_CONCURRENCY['sms'],
+    'socialmessaging': CHANNEL_CONCURRENCY['whatsapp']
+}
+
+CONNECT_TIMEOUT = float(os.environ.get('AWS_CONNECT_TIMEOUT', '2'))
+READ_TIMEOUT = float(os.environ.get('AWS_READ_TIMEOUT', '10'))
+PREWARM_CONNECTIONS = os.environ.get('PREWARM_CONNECTIONS', 'true') == 'true'
+
+# One session shared by every client of the container. Only low-level clients
+# are used, so botocore's session is enough and boto3 is never imported.
+session = botocore.session.get_session()
+
+def make_config(service_name):
+    # The channel drivers retry sends themselves within the invocation's time
+    # budget (see retry.py), so their clients make a single attempt
+    if service_name in POOL_SIZES:
+        retries = {'mode': 'standard', 'total_max_attempts': 1}
+    else:
+        retries = {'mode': 'adaptive', 'max_attempts': 3}
+    return Config(
+        max_pool_connections=POOL_SIZES.get(service_name, MAX_CONCURRENCY),
+        tcp_keepalive=True,
+        connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=READ_TIMEOUT,
+        retries=retries
+    )
+
+def prewarm(client):
+    # Open one TLS connection during init so the first call of an invocation
+    # does not pay for the handshake. botocore has no public hook for this.
+    try:
+        endpoint = client._endpoint
+        http_session = endpoint.http_session
+        pool = http_session._get_connection_manager(endpoint.host).connection_from_url(endpoint.host)
+        http_session._setup_ssl_cert(pool, endpoint.host, http_session._verify)
+        connection = pool._get_conn()
+        connection.connect()
+        pool._put_conn(connection)
+    except Exception as e:
+        print(f"Could not pre-establish connection to {client.meta.service_model.service_name}:", e)
+
+# Channel clients are only built the first time a channel is used, so a
+# container never loads the service models of channels it does not serve
+clients = {}
+clients_lock = threading.Lock()
+
+def get_client(service_name):
+    client = clients.get(service_name)
+    if client is None:
+        with clients_lock:
+            client = clients.get(service_name)
+            if client is None:
+                client = clients[service_name] = session.create_client(service_name, config=make_config(service_name))
+    return client
+
+def init_client(service_name):
+    # Builds a client during init, for services every invocation calls
+    client = get_client(service_name)
+    if PREWARM_CONNECTIONS:
+        prewarm(client)
+    return client
+
+dynamodb = init_client('dynamodb')
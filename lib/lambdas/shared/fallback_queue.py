@@ -0,0 +1,69 @@
+import json
+import os
+import time
+from botocore.exceptions import BotoCoreError, ClientError
+from aws_clients import get_client
+
+# SendMessageBatch accepts at most 10 entries per call
+MAX_BATCH_SIZE = 10
+
+# SQS delays a message by at most 15 minutes. A longer fallback carries its
+# due time in fallback_at and the secondary handler enqueues it again until then.
+MAX_DELAY_SECONDS = 900
+MAX_ATTEMPTS = 3
+BASE_BACKOFF_SECONDS = 0.1
+
+def schedule_fallbacks(fallbacks):
+    # Each fallback is a dict with record_id, body and delay_seconds.
+    # Returns the record_ids whose fallback could not be enqueued.
+    sqs = get_client('sqs')
+    now = int(time.time())
+    for fallback in fallbacks:
+        if fallback['delay_seconds'] > MAX_DELAY_SECONDS:
+            fallback['body'].setdefault('fallback_at', now + fallback['delay_seconds'])
+            fallback['delay_seconds'] = MAX_DELAY_SECONDS
+
+    pending = {str(index): fallback for index, fallback in enumerate(fallbacks)}
+    failed_record_ids = []
+
+    for attempt in range(MAX_ATTEMPTS):
+        if attempt:
+            time.sleep(BASE_BACKOFF_SECONDS * 2 ** (attempt - 1))
+
+        retry = {}
+        entry_ids = list(pending)
+        for start in range(0, len(entry_ids), MAX_BATCH_SIZE):
+            chunk = entry_ids[start:start + MAX_BATCH_SIZE]
+            try:
+                response = sqs.send_message_batch(
+                    QueueUrl=os.environ['FALLBACK_QUEUE_URL'],
+                    Entries=[
+                        {
+                            'Id': entry_id,
+                            'MessageBody': json.dumps(pending[entry_id]['body']),
+                            'DelaySeconds': pending[entry_id]['delay_seconds']
+                        }
+                        for entry_id in chunk
+                    ]
+                )
+            except (ClientError, BotoCoreError) as e:
+                # Connection errors and timeouts once botocore gave up retrying
+                print("Error sending fallback batch:", e)
+                retry.update((entry_id, pending[entry_id]) for entry_id in chunk)
+                continue
+
+            for failure in response.get('Failed', []):
+                fallback = pending[failure['Id']]
+                if failure.get('SenderFault'):
+                    # The entry itself is invalid, sending it again will not help
+                    print("Fallback rejected for record", fallback['record_id'], failure.get('Message'))
+                    failed_record_ids.append(fallback['record_id'])
+                else:
+                    retry[failure['Id']] = fallback
+
+        pending = retry
+        if not pending:
+            break
+
+    failed_record_ids.extend(fallback['record_id'] for fallback in pending.values())
+    return failed_record_ids
@@ -0,0 +1,178 @@
+import os
+import time
+from decimal import Decimal
+from botocore.exceptions import BotoCoreError, ClientError
+from aws_clients import dynamodb
+
+TABLE_NAME = os.environ['DYNAMODB_TABLE_NAME']
+
+# BatchWriteItem accepts at most 25 put requests per call, BatchGetItem 100 keys
+MAX_BATCH_SIZE = 25
+MAX_BATCH_GET_SIZE = 100
+MAX_ATTEMPTS = 5
+BASE_BACKOFF_SECONDS = 0.05
+
+# The message item has a fixed shape: every attribute is a string except
+# fallback_body, the fallback channel object taken from the request
+STRING_ATTRIBUTES = (
+    'messageId',
+    'recipient',
+    'sender',
+    'message',
+    'primary_channel',
+    'use_case',
+    'status',
+    'fallback_channel',
+    'pc_message_sent_timestamp'
+)
+
+# Attribute values that never change are encoded once
+NULL = {'NULL': True}
+STATUS_DELIVERED = {'S': 'delivered'}
+STATUS_SENT_FALLBACK = {'S': 'sent_fallback'}
+
+def encode_string(value):
+    return NULL if value is None else {'S': value}
+
+def encode_value(value):
+    # Request bodies only hold JSON types, so this is all the type mapping needed
+    if isinstance(value, str):
+        return {'S': value}
+    if isinstance(value, bool):
+        return {'BOOL': value}
+    if value is None:
+        return NULL
+    if isinstance(value, (int, float, Decimal)):
+        return {'N': str(value)}
+    if isinstance(value, dict):
+        return {'M': {key: encode_value(item) for key, item in value.items()}}
+    if isinstance(value, (list, tuple)):
+        return {'L': [encode_value(item) for item in value]}
+    raise TypeError(f"Unsupported attribute value type {type(value).__name__}")
+
+def encode_message_item(item):
+    encoded = {name: encode_string(item[name]) for name in STRING_ATTRIBUTES}
+    encoded['fallback_body'] = encode_value(item['fallback_body'])
+    # Only set when the fallback already went out with the primary attempt
+    if 'fc_message_sent_timestamp' in item:
+        encoded['fc_message_sent_timestamp'] = encode_string(item['fc_message_sent_timestamp'])
+    return encoded
+
+def message_key(message_id):
+    return {'messageId': {'S': message_id}}
+
+def store_messages(items):
+    # Returns the messageIds of the items that could not be written
+    failed_message_ids = []
+
+    for start in range(0, len(items), MAX_BATCH_SIZE):
+        requests = [
+            {'PutRequest': {'Item': encode_message_item(item)}}
+            for item in items[start:start + MAX_BATCH_SIZE]
+        ]
+
+        for attempt in range(MAX_ATTEMPTS):
+            if attempt:
+                time.sleep(BASE_BACKOFF_SECONDS * 2 ** (attempt - 1))
+            try:
+                response = dynamodb.batch_write_item(RequestItems={TABLE_NAME: requests})
+            except (ClientError, BotoCoreError) as e:
+                # Connection errors and timeouts once botocore gave up retrying
+                print("Error writing messages to DynamoDB:", e)
+                break
+            # Throttled or capacity-limited writes come back to be sent again
+            requests = response.get('UnprocessedItems', {}).get(TABLE_NAME, [])
+            if not requests:
+                break
+
+        failed_message_ids.extend(request['PutRequest']['Item']['messageId']['S'] for request in requests)
+
+    return failed_message_ids
+
+def get_messages(message_ids):
+    # Reads the status of many messages with as few calls as possible. Messages
+    # that are not tracked are left out, those that could not be read map to
+    # None so the caller does not mistake them for untracked ones.
+    statuses = {}
+    message_ids = list(dict.fromkeys(message_ids))
+
+    for start in range(0, len(message_ids), MAX_BATCH_GET_SIZE):
+        chunk = message_ids[start:start + MAX_BATCH_GET_SIZE]
+        request = {
+            TABLE_NAME: {
+                'Keys': [message_key(message_id) for message_id in chunk],
+                'ProjectionExpression': 'messageId, #status',
+                'ExpressionAttributeNames': {'#status': 'status'}
+            }
+        }
+
+        for attempt in range(MAX_ATTEMPTS):
+            if attempt:
+                time.sleep(BASE_BACKOFF_SECONDS * 2 ** (attempt - 1))
+            try:
+                response = dynamodb.batch_get_item(RequestItems=request)
+            except (ClientError, BotoCoreError) as e:
+                # The keys that were not read map to None below
+                print("Error reading messages from DynamoDB:", e)
+                break
+            for item in response['Responses'].get(TABLE_NAME, []):
+                statuses[item['messageId']['S']] = item.get('status', {}).get('S')
+            # Throttled or capacity-limited reads come back to be sent again
+            request = response.get('UnprocessedKeys', {})
+            if not request:
+                break
+
+        if request:
+            for key in request[TABLE_NAME]['Keys']:
+                statuses[key['messageId']['S']] = None
+
+    return statuses
+
+def claim_fallback(message_id, fc_message_sent_timestamp):
+    # Checks the message and marks its fallback sent in one conditional write,
+    # before the send. Returns the status it had, or None when the message is
+    # not tracked, was delivered or already fell back.
+    try:
+        response = dynamodb.update_item(
+            TableName=TABLE_NAME,
+            Key=message_key(message_id),
+            UpdateExpression='SET #status = :sent_fallback, #fc_timestamp = :fc_timestamp',
+            ConditionExpression='attribute_exists(messageId) AND NOT #status IN (:delivered, :sent_fallback)',
+            ExpressionAttributeNames={
+                '#status': 'status',
+                '#fc_timestamp': 'fc_message_sent_timestamp'
+            },
+            ExpressionAttributeValues={
+                ':delivered': STATUS_DELIVERED,
+                ':sent_fallback': STATUS_SENT_FALLBACK,
+                ':fc_timestamp': {'S': fc_message_sent_timestamp}
+            },
+            ReturnValues='UPDATED_OLD'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return None
+        raise
+    return response['Attributes']['status']
+
+def release_fallback(message_id, status, fc_message_sent_timestamp):
+    # The fallback send failed, the message gets back the status it had before
+    # the claim so the redelivered record can claim it again
+    try:
+        dynamodb.update_item(
+            TableName=TABLE_NAME,
+            Key=message_key(message_id),
+            UpdateExpression='SET #status = :status REMOVE #fc_timestamp',
+            ConditionExpression='#status = :sent_fallback AND #fc_timestamp = :fc_timestamp',
+            ExpressionAttributeNames={
+                '#status': 'status',
+                '#fc_timestamp': 'fc_message_sent_timestamp'
+            },
+            ExpressionAttributeValues={
+                ':status': status,
+                ':sent_fallback': STATUS_SENT_FALLBACK,
+                ':fc_timestamp': {'S': fc_message_sent_timestamp}
+            }
+        )
+    except ClientError as e:
+        print(f"Error releasing fallback claim of message {message_id}:", e)
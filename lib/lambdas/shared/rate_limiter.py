@@ -0,0 +1,145 @@
+import math
+import os
+import threading
+import time
+from botocore.exceptions import BotoCoreError, ClientError
+from aws_clients import dynamodb, get_client
+
+# Per-second send counters shared by every Lambda container. Without a table
+# name the limiter is off.
+STATE_TABLE_NAME = os.environ.get('STATE_TABLE_NAME')
+
+# Send rates the provider quotas cannot be read from. SMS throughput is set per
+# origination number, WhatsApp per business phone number.
+CHANNEL_RATES = {
+    'sms': float(os.environ.get('SMS_MESSAGES_PER_SECOND', '1')),
+    'whatsapp': float(os.environ.get('WHATSAPP_MESSAGES_PER_SECOND', '80'))
+}
+
+# The fleet aims just under the provider limit
+RATE_LIMIT_HEADROOM = float(os.environ.get('RATE_LIMIT_HEADROOM', '0.9'))
+MAX_WAIT_SECONDS = float(os.environ.get('RATE_LIMIT_MAX_WAIT_SECONDS', '5'))
+
+# Tokens a container takes from the shared counter at a time, so most sends
+# are served locally without a DynamoDB call
+MAX_LEASE = 10
+
+ACCOUNT_QUOTA_TTL_SECONDS = 3600
+# A quota that could not be read is asked for again soon
+ACCOUNT_QUOTA_RETRY_SECONDS = 30
+COUNTER_TTL_SECONDS = 60
+
+account_quota = {'rate': None, 'expires_at': 0}
+buckets = {}
+buckets_lock = threading.Lock()
+
+def ses_send_rate():
+    # SES enforces one send rate for the whole account, refreshed now and then
+    now = time.monotonic()
+    if account_quota['expires_at'] <= now:
+        try:
+            response = get_client('sesv2').get_account()
+            account_quota['rate'] = response['SendQuota']['MaxSendRate']
+            account_quota['expires_at'] = now + ACCOUNT_QUOTA_TTL_SECONDS
+        except Exception as e:
+            print("Could not read the SES send quota:", e)
+            # The last known rate, or the sandbox rate, until the quota can be read again
+            account_quota['rate'] = account_quota['rate'] or 1
+            account_quota['expires_at'] = now + ACCOUNT_QUOTA_RETRY_SECONDS
+    return account_quota['rate']
+
+def bucket_key(channel, sender):
+    return 'email' if channel == 'email' else f'{channel}#{sender}'
+
+def send_limit(channel):
+    rate = ses_send_rate() if channel == 'email' else CHANNEL_RATES[channel]
+    return max(1, math.floor(rate * RATE_LIMIT_HEADROOM))
+
+def lease_tokens(key, second, limit, lease):
+    # Takes tokens from the counter of the current second, only while the
+    # fleet stays within the limit. Returns the number of tokens taken.
+    try:
+        dynamodb.update_item(
+            TableName=STATE_TABLE_NAME,
+            Key={'pk': {'S': f'rate#{key}#{second}'}},
+            UpdateExpression='ADD #tokens :lease SET #expires_at = :expires_at',
+            ConditionExpression='attribute_not_exists(#tokens) OR #tokens <= :remaining',
+            ExpressionAttributeNames={
+                '#tokens': 'tokens',
+                '#expires_at': 'expires_at'
+            },
+            ExpressionAttributeValues={
+                ':lease': {'N': str(lease)},
+                ':remaining': {'N': str(limit - lease)},
+                ':expires_at': {'N': str(second + COUNTER_TTL_SECONDS)}
+            }
+        )
+        return lease
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return 0
+        # The send is not held back when the counter cannot be reached
+        print("Error leasing send tokens:", e)
+        return lease
+    except BotoCoreError as e:
+        print("Error leasing send tokens:", e)
+        return lease
+
+class TokenBucket:
+    def __init__(self, key, channel):
+        self.key = key
+        self.channel = channel
+        self.second = None
+        self.tokens = 0
+        self.exhausted = False
+        self.lock = threading.Lock()
+
+    def take(self):
+        # Returns 0 when the token was taken, otherwise the seconds until the next window
+        with self.lock:
+            now = time.time()
+            second = int(now)
+            if second != self.second:
+                # Leased tokens are only valid in the second they were leased for
+                self.second = second
+                self.tokens = 0
+                self.exhausted = False
+            if not self.tokens and not self.exhausted:
+                limit = send_limit(self.channel)
+                self.tokens = lease_tokens(self.key, second, limit, min(MAX_LEASE, limit))
+                if not self.tokens and limit > 1:
+                    # A single token may still fit under the limit
+                    self.tokens = lease_tokens(self.key, second, limit, 1)
+                # The fleet used up this second, nobody here asks again before the next one
+                self.exhausted = not self.tokens
+            if self.tokens:
+                self.tokens -= 1
+                return 0
+            return second + 1 - now
+
+def get_bucket(channel, sender):
+    key = bucket_key(channel, sender)
+    bucket = buckets.get(key)
+    if bucket is None:
+        with buckets_lock:
+            bucket = buckets.setdefault(key, TokenBucket(key, channel))
+    return bucket
+
+def acquire(channel, sender, count=1):
+    # Blocks until the fleet may send count more messages on the channel and
+    # sender, for at most MAX_WAIT_SECONDS. Returns how many of them may be
+    # sent, so a group larger than the wait allows goes out in part.
+    if STATE_TABLE_NAME is None or (channel != 'email' and channel not in CHANNEL_RATES):
+        return count
+    bucket = get_bucket(channel, sender)
+    deadline = time.monotonic() + MAX_WAIT_SECONDS
+    for acquired in range(count):
+        while True:
+            wait = bucket.take()
+            if not wait:
+                break
+            if time.monotonic() + wait > deadline:
+                print(f"Send rate limit reached for {bucket.key}")
+                return acquired
+            time.sleep(wait)
+    return count
@@ -0,0 +1,85 @@
+import os
+import random
+import threading
+import time
+from collections import Counter
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+MAX_ATTEMPTS = int(os.environ.get('SEND_MAX_ATTEMPTS', '5'))
+BASE_BACKOFF_SECONDS = float(os.environ.get('SEND_BASE_BACKOFF_SECONDS', '0.1'))
+MAX_BACKOFF_SECONDS = float(os.environ.get('SEND_MAX_BACKOFF_SECONDS', '5'))
+
+# Time kept free at the end of an invocation for storing and scheduling the batch
+RESERVED_SECONDS = float(os.environ.get('RETRY_RESERVED_SECONDS', '5'))
+
+# Throttling and provider-side failures of SES, End User Messaging SMS and
+# WhatsApp. Anything else (validation, access, missing resources, exhausted
+# daily quotas) fails the same way when sent again.
+RETRYABLE_ERROR_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledRequestException',
+    'TooManyRequestsException',
+    'InternalServiceException',
+    'InternalServerException',
+    'InternalFailure',
+    'ServiceUnavailable',
+    'ServiceUnavailableException',
+    'DependencyException',
+    'RequestTimeout',
+    'RequestTimeoutException'
+}
+
+# Retry budget of the running invocation, shared by every worker thread
+budget = {'deadline': None}
+stats = Counter()
+stats_lock = threading.Lock()
+
+def start_invocation(context):
+    stats.clear()
+    if context is None:
+        budget['deadline'] = None
+    else:
+        budget['deadline'] = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - RESERVED_SECONDS
+
+def report():
+    if stats:
+        print("Send retries:", dict(stats))
+
+def error_code(error):
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code')
+    # Connection failures and timeouts never reached the provider
+    if isinstance(error, (ConnectionError, HTTPClientError)):
+        return type(error).__name__
+    return None
+
+def is_retryable(error):
+    if isinstance(error, ClientError):
+        code = error_code(error)
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return code in RETRYABLE_ERROR_CODES or status >= 500
+    return isinstance(error, (ConnectionError, HTTPClientError))
+
+def call(operation, **params):
+    # Calls a provider operation, retrying retryable errors with full-jitter
+    # exponential backoff while the invocation's budget allows it
+    attempt = 1
+    while True:
+        try:
+            return operation(**params)
+        except Exception as e:
+            if not is_retryable(e) or attempt >= MAX_ATTEMPTS:
+                raise
+            delay = random.uniform(0, min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * 2 ** attempt))
+            deadline = budget['deadline']
+            if deadline is not None and time.monotonic() + delay > deadline:
+                with stats_lock:
+                    stats['budget_exhausted'] += 1
+                raise
+            with stats_lock:
+                stats['retries'] += 1
+                stats[error_code(e)] += 1
+                stats['wait_ms'] += round(delay * 1000)
+            time.sleep(delay)
+            attempt += 1
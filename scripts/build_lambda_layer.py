@@ -0,0 +1,118 @@
+"""Build the runtime dependency layer shared by the primary and secondary handlers.
+
+The handlers only talk to AWS through low-level botocore clients, so the layer
+holds botocore and what it imports (urllib3, jmespath, python-dateutil, six)
+taken from the versions vendored in PrimaryHandlerLambda, along with the
+modules both handlers use from lib/lambdas/shared. botocore/data is cut
+down to the service models the handlers call, stale __pycache__ directories,
+dist-info metadata and console scripts are dropped, and everything is
+precompiled to bytecode for the Lambda runtime.
+
+    python3 scripts/build_lambda_layer.py [--output build/lambda-layer]
+
+The bytecode is only loaded by the interpreter version that produced it, so
+run the compile step with Python 3.12 (the runtime of both functions). When
+that interpreter is not available the layer is built without bytecode.
+"""
+import argparse
+import compileall
+import os
+import py_compile
+import shutil
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+DEFAULT_SOURCE = os.path.join(ROOT, "lib", "lambdas", "PrimaryHandlerLambda")
+DEFAULT_OUTPUT = os.path.join(ROOT, "build", "lambda-layer")
+SHARED_MODULES = os.path.join(ROOT, "lib", "lambdas", "shared")
+
+# Packages the handlers import at runtime, directly or through botocore
+PACKAGES = ["botocore", "urllib3", "jmespath", "dateutil", "six.py"]
+
+# The only services the handlers create clients for
+SERVICE_MODELS = ["sesv2", "pinpoint-sms-voice-v2", "socialmessaging", "sqs", "dynamodb"]
+
+RUNTIME_PYTHON = "python3.12"
+
+
+def copy_packages(source, site_packages):
+    ignore = shutil.ignore_patterns("__pycache__", "*.pyc")
+    for package in PACKAGES:
+        path = os.path.join(source, package)
+        if os.path.isdir(path):
+            shutil.copytree(path, os.path.join(site_packages, package), ignore=ignore)
+        else:
+            shutil.copy2(path, site_packages)
+
+
+def copy_shared_modules(site_packages):
+    # The client registry, message store, fallback queue, rate limiter and
+    # retry helpers are kept in one place instead of a copy per handler
+    for name in os.listdir(SHARED_MODULES):
+        if name.endswith(".py"):
+            shutil.copy2(os.path.join(SHARED_MODULES, name), site_packages)
+
+
+def prune_service_models(site_packages):
+    data = os.path.join(site_packages, "botocore", "data")
+    for name in os.listdir(data):
+        path = os.path.join(data, name)
+        # Top level files (endpoints, partitions, retry and default config) are always needed
+        if os.path.isdir(path) and name not in SERVICE_MODELS:
+            shutil.rmtree(path)
+
+
+def compile_bytecode(site_packages, python):
+    # Unchecked hash based .pyc files stay valid after the asset zip resets file timestamps
+    if python == sys.executable:
+        compileall.compile_dir(site_packages, quiet=1,
+                               invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+        return
+    subprocess.run(
+        [python, "-m", "compileall", "-q", "--invalidation-mode", "unchecked-hash", site_packages],
+        check=True,
+    )
+
+
+def directory_size(path):
+    return sum(
+        os.path.getsize(os.path.join(directory, name))
+        for directory, _, names in os.walk(path) for name in names
+    )
+
+
+def build(source, output, python):
+    if os.path.exists(output):
+        shutil.rmtree(output)
+    # Lambda adds /opt/python of every layer to sys.path
+    site_packages = os.path.join(output, "python")
+    os.makedirs(site_packages)
+
+    copy_packages(source, site_packages)
+    copy_shared_modules(site_packages)
+    prune_service_models(site_packages)
+    if python:
+        compile_bytecode(site_packages, python)
+    return site_packages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--source", default=DEFAULT_SOURCE, help="directory holding the vendored packages")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="layer directory to (re)create")
+    parser.add_argument("--python", default=shutil.which(RUNTIME_PYTHON),
+                        help=f"interpreter used to precompile bytecode (default: {RUNTIME_PYTHON} on PATH)")
+    parser.add_argument("--no-bytecode", action="store_true", help="skip precompiling bytecode")
+    args = parser.parse_args()
+
+    python = None if args.no_bytecode else args.python
+    if not args.no_bytecode and not python:
+        print(f"{RUNTIME_PYTHON} not found, building the layer without bytecode", file=sys.stderr)
+
+    site_packages = build(args.source, args.output, python)
+    print(f"Layer written to {args.output} ({directory_size(site_packages) / 2 ** 20:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()